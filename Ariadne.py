@@ -1,10 +1,16 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, func, bindparam, literal, exists
+from sqlalchemy.orm import sessionmaker, scoped_session, aliased, joinedload
 import mbdata.models as mb
 import pandas as pd
 import yaml
 import numpy as np
 import json
+import functools
+import threading
+import sys
+import re
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, namedtuple
 
 """
 A Knot is one point in the music exploration. 
@@ -13,8 +19,13 @@ It includes a MB Recording object, and Knot and Thread objects referring to the
 previous recording and how it led to this one.
 """
 class Knot(object):
+    # Knots are built for every candidate recording, so they use slots
+    # instead of a per-instance dict
+    __slots__ = ('rec', 'creditedArtists', 'inThread', 'prevKnot', 'id',
+                 'rendered')
+
     def __init__(self, r, cArtists, iThread=None, pKnot=None, knotID=-1):
-        # MB Recording object containing the actual music
+        # MB Recording object or RecordingStub containing the actual music
         self.rec = r
         # CreditedArtists object
         self.creditedArtists = cArtists
@@ -24,12 +35,17 @@ class Knot(object):
         self.prevKnot = pKnot
         # ID if Knot has been used
         self.id = knotID
+        # Rendered string, once rendered
+        self.rendered = None
 
     # Returns a string describing the Knot
+    # The Recording and its Artists do not change, so it is only built once
     def render(self):
-        renderString = '"' + self.rec.name + '", by ' +\
-                       self.creditedArtists.render()
-        return renderString.encode('utf-8')
+        if self.rendered is None:
+            renderString = '"%s", by %s' % (self.rec.name,
+                    self.creditedArtists.renderNames())
+            self.rendered = renderString.encode('utf-8')
+        return self.rendered
 
     # Serialize object data into struct to be parsed for JSON encoding
     def serialize(self):
@@ -47,25 +63,33 @@ A CreditedArtists object wraps one or many MB Artist objects to which a given
 Recording is credited
 """
 class CreditedArtists(object):
+    # One is built for every Knot, so it uses slots as well
+    __slots__ = ('artistList', 'renderedNames')
+
     def __init__(self, artistList):
-        if type(artistList) is not list:
+        if not isinstance(artistList, (list, tuple)):
             artistList = [artistList]
         self.artistList = artistList
+        # Rendered artist names, once renderNames has been called
+        self.renderedNames = None
     
+    # Returns the artist names as unicode, as "A", "A and B" or "A, B and C",
+    # to be used within other rendered strings
+    # The same object is rendered by its Knot and by every Thread leading to
+    # it, so the result is kept after the first call
+    def renderNames(self):
+        if self.renderedNames is None:
+            names = [artist.name for artist in self.artistList]
+            if len(names) == 1:
+                self.renderedNames = names[0]
+            else:
+                self.renderedNames = ', '.join(names[:-1]) + ' and ' + \
+                                     names[-1]
+        return self.renderedNames
+
+    # Renders the artist names into output
     def render(self):
-        renderString = ''
-        nArtists = len(self.artistList)
-        if nArtists == 1:
-            renderString = self.artistList[0].name
-        elif nArtists == 2:
-            renderString = self.artistList[0].name + ' and ' +\
-                    self.artistList[1].name
-        else:
-            renderString = self.artistList[0].name
-            for i in range(1, nArtists-1):
-                renderString += ', ' + self.artistList[i].name
-            renderString += ' and ' + self.artistList[nArtists-1].name
-        return renderString.encode('utf-8')
+        return self.renderNames().encode('utf-8')
 
 
 """
@@ -74,10 +98,18 @@ As an abstract class, it is up to the specific implementation of a Thread
 subclass to determine how two Knots might be connected.
 """
 class Thread(object):
+    # Threads are built for every candidate recording, so they use slots
+    # instead of a per-instance dict. Subclasses declare their own extra slots
+    __slots__ = ('fromKnot', 'toKnot', 'id', 'rendered')
+
     def __init__(self, fKnot, tKnot):
         # Knots connected by this Thread
         self.fromKnot = fKnot
         self.toKnot = tKnot
+        # ID if Thread has been offered to the user
+        self.id = -1
+        # Rendered string, once rendered
+        self.rendered = None
 
     # Queries the database to fin possible Knots implementing the specific
     # connection logic of each ThreadType
@@ -85,23 +117,108 @@ class Thread(object):
     def getAllPossibleThreads(db, fromKnot):
         raise NotImplementedError("Should have implemented this")
 
+    # Returns the possible Threads of this type from each of several Knots, as
+    # a list of lists in the same order as the Knots
+    # By default every Knot is explored on its own. Thread types whose queries
+    # can be shared between Knots override it to run them once for all Knots
+    @classmethod
+    def getAllPossibleThreadsFromKnots(cls, db, fromKnots, select):
+        return [cls.getAllPossibleThreads(db, fromKnot, select)
+                for fromKnot in fromKnots]
+
     # Renders the thread data into output
+    # Threads do not change once built, so the same Threads offered again are
+    # not rendered again
     def render(self):
+        if self.rendered is None:
+            self.rendered = self.renderThread()
+        return self.rendered
+
+    # Builds the rendered string of the thread data, specific to each
+    # ThreadType
+    def renderThread(self):
         raise NotImplementedError("Should have implemented this")
+
+    # Renders a list of Threads, e.g. to present them as options
+    @staticmethod
+    def renderMany(threads):
+        return [t.render() for t in threads]
     
     # Serializes Thread data to be encoded as JSON
-    def serialize(self):
+    # knotStructs optionally holds the Knots already serialized along with
+    # other Threads
+    def serialize(self, knotStructs=None):
         raise NotImplementedError("Should have implemented this")
 
+    # Serializes a list of Threads, e.g. to send them as options
+    # Threads offered together usually start at the same Knot, so each Knot
+    # is only serialized once
+    @staticmethod
+    def serializeMany(threads):
+        knotStructs = {}
+        return [t.serialize(knotStructs) for t in threads]
+
+    # Serializes one of the Thread's Knots, reusing its struct if it is in
+    # knotStructs
+    @staticmethod
+    def serializeKnot(knot, knotStructs=None):
+        if knotStructs is None:
+            return knot.serialize()
+        if id(knot) not in knotStructs:
+            knotStructs[id(knot)] = knot.serialize()
+        return knotStructs[id(knot)]
+
     # Determines whether a Thread can be started from a given Knot
     @staticmethod
     def isApplicable(db, fromKnot):
         raise NotImplementedError("Should have implemented this")
     
     # Returns the nResults "best" threads of a given type
+    # Returning random threads from each rank group for now
+    @classmethod
+    def rank(cls, threads, nResults):
+        best = []
+        for groupBest in Thread.sampleMany(cls.rankGroups(threads), nResults):
+            best += groupBest
+        return best
+
+    # Splits the threads of a given type into the groups that rank draws from
+    # By default, all of them form a single group
     @staticmethod
-    def rank(threads, nResults):
-        raise NotImplementedError("Should have implemented this")
+    def rankGroups(threads):
+        return [threads]
+
+    # Builds the Knots reached from a given Knot through a list of Recordings,
+    # fetching the credited Artists of all of them at once
+    @staticmethod
+    def buildToKnots(db, fromKnot, toRecs):
+        artistsByRec = db.getArtistsByRecordings(toRecs)
+        return [Knot(toRec, CreditedArtists(artistsByRec[toRec.gid]),
+                     pKnot=fromKnot)
+                for toRec in toRecs]
+
+    # Makes a Thread of the given type from a Knot to each of a list of Knots.
+    # Any further arguments are passed on to the Thread type's constructor
+    @staticmethod
+    def linkKnots(threadType, fromKnot, toKnots, *args):
+        threads = []
+        for toKnot in toKnots:
+            newThread = threadType(fromKnot, toKnot, *args)
+            toKnot.inThread = newThread
+            threads.append(newThread)
+        return threads
+
+    # Draws nResults random Threads, with replacement, from each of a list of
+    # non-empty groups of Threads
+    # Indices for all groups are drawn in a single numpy call and then used to
+    # pick the Threads, which avoids building numpy arrays of Thread objects
+    @staticmethod
+    def sampleMany(groups, nResults):
+        lengths = np.array([len(group) for group in groups])
+        indices = np.random.randint(0, lengths[:, np.newaxis],
+                                    size=(len(groups), nResults))
+        return [[group[i] for i in groupIndices]
+                for group, groupIndices in zip(groups, indices.tolist())]
 
 
 """
@@ -109,6 +226,7 @@ ThreadBySameArtist: two recordings by the same artist
 """
 class ThreadBySameArtist(Thread):
     descText = 'A song by the same artist'
+    __slots__ = ('artist',)
     # This Thread type additionally stores an Artist object connecting the
     # recordings
     def __init__(self, fKnot, tKnot, artist):
@@ -119,28 +237,41 @@ class ThreadBySameArtist(Thread):
     # iterate all credited artists and find some recordings by them
     @staticmethod
     def getAllPossibleThreads(db, fromKnot, recsPerCreditedArtist=50):
-        fromRec = fromKnot.rec
-        fromArtists = fromKnot.creditedArtists
-        threads = []
-        for thisArtist in fromArtists.artistList:
-            thisArtistRecs = db.getRecordingsByArtist(thisArtist,
-                    recsPerCreditedArtist)
-            thisArtistThreads = ThreadBySameArtist.makeThreads(db, fromKnot,
-                    thisArtistRecs, thisArtist)
-            threads += thisArtistThreads
-        return threads
+        return ThreadBySameArtist.getAllPossibleThreadsFromKnots(db,
+                [fromKnot], recsPerCreditedArtist)[0]
+
+    # From several Knots, some recordings by every credited artist of all of
+    # them are fetched in a single query
+    @classmethod
+    def getAllPossibleThreadsFromKnots(cls, db, fromKnots,
+            recsPerCreditedArtist=50):
+        fromArtists = OrderedDict()
+        for fromKnot in fromKnots:
+            for artist in fromKnot.creditedArtists.artistList:
+                fromArtists[artist.gid] = artist
+        recsByArtist = db.getRecordingsByArtists(fromArtists.values(),
+                recsPerCreditedArtist)
+        threadsPerKnot = []
+        for fromKnot in fromKnots:
+            threads = []
+            for thisArtist in fromKnot.creditedArtists.artistList:
+                thisArtistRecs = recsByArtist[thisArtist.gid]
+                thisArtistThreads = cls.makeThreads(db, fromKnot,
+                        thisArtistRecs, thisArtist)
+                threads += thisArtistThreads
+            threadsPerKnot.append(threads)
+        return threadsPerKnot
     
-    def render(self):
-        renderString = '"' + self.toKnot.rec.name + '"' +\
-                       ', also by ' +\
-                       self.toKnot.creditedArtists.render()
+    def renderThread(self):
+        renderString = '"%s", also by %s' % (self.toKnot.rec.name,
+                self.toKnot.creditedArtists.renderNames())
         return renderString.encode('utf-8')
     
-    def serialize(self):
+    def serialize(self, knotStructs=None):
         struct = {
                 'type': 'ThreadBySameArtist',
-                'fromKnot': self.fromKnot.serialize(),
-                'toKnot': self.toKnot.serialize(),
+                'fromKnot': self.serializeKnot(self.fromKnot, knotStructs),
+                'toKnot': self.serializeKnot(self.toKnot, knotStructs),
                 'id': self.id,
                 'artist': self.artist.name
                 }
@@ -151,29 +282,23 @@ class ThreadBySameArtist(Thread):
     def isApplicable(db, fromKnot):
         return True
     
-    # Returning a random thread per unique artist for now
+    # Ranking draws from each unique artist separately
+    # Threads are grouped by artist GID in a single pass, in the order their
+    # artists are first found
     @staticmethod
-    def rank(threads, nResults):
-        uniqueArtists = np.unique([t.artist for t in threads])
-        best=[]
-        for thisArtist in uniqueArtists:
-            thisArtistThreads = [t for t in threads if t.artist is thisArtist]
-            best += np.random.choice(thisArtistThreads, nResults).tolist()
-        return best
+    def rankGroups(threads):
+        threadsByArtist = OrderedDict()
+        for t in threads:
+            threadsByArtist.setdefault(t.artist.gid, []).append(t)
+        return threadsByArtist.values()
 
     # Returns a list of Threads given a starting Knot, a list of ending
     # Recordings and the artist that they share.
     @staticmethod
     def makeThreads(db, fromKnot, toRecs, fromArtist):
-        threads = []
-        for toRec in toRecs:
-            toCreditedArtistsList = db.getArtistsByRecording(toRec, 'ALL')
-            toCreditedArtists = CreditedArtists(toCreditedArtistsList)
-            toKnot = Knot(toRec, toCreditedArtists, pKnot=fromKnot)
-            newThread = ThreadBySameArtist(fromKnot, toKnot, fromArtist)
-            toKnot.inThread = newThread
-            threads.append(newThread)
-        return threads
+        toKnots = Thread.buildToKnots(db, fromKnot, toRecs)
+        return Thread.linkKnots(ThreadBySameArtist, fromKnot, toKnots,
+                fromArtist)
 
 """
 ThreadByGroupWithMembersInCommon: a recording by a group with a member in common
@@ -181,62 +306,80 @@ with the previous one.
 """
 class ThreadByGroupWithMembersInCommon(Thread):
     descText = 'A song by a group with a member in common'
-    # This Thread type additionally stores the names of both groups, and the
-    # name of the group member in common
-    def __init__(self, fKnot, tKnot, fGroup, tGroup, member):
+    __slots__ = ('fromGroup', 'toGroup', 'membersInCommon')
+    # This Thread type additionally stores both groups, and the list of group
+    # members they have in common
+    def __init__(self, fKnot, tKnot, fGroup, tGroup, members):
         super(ThreadByGroupWithMembersInCommon, self).__init__(fKnot, tKnot)
         self.fromGroup = fGroup
         self.toGroup = tGroup
-        self.memberInCommon = member
+        self.membersInCommon = members
     
     # To get the next threads from a certain Knot, we iterate all credited
     # groups.
-    # We find all group members and the other groups they were part of.
-    # For each member-group pair, we find some recordings.
-    # For each member-group-recording combination, we make a new Thread.
+    # We find the other groups that their members were part of, together with
+    # the members each of them has in common with the credited group.
+    # We find some recordings for all those groups at once.
+    # For each group-recording combination, we make a new Thread.
     @staticmethod
     def getAllPossibleThreads(db, fromKnot, recsPerMemberGroupPair=50):
         fromRec = fromKnot.rec
         fromArtists = fromKnot.creditedArtists
         fromGroups = [artist for artist in fromArtists.artistList
                 if db.isGroup(artist)]
+        # Get groups with members in common for all credited groups
+        fromGroupPairs = [(fromGroup, mgPair) for fromGroup in fromGroups
+                for mgPair in db.getGroupsWithMembersInCommon(fromGroup)]
+        # Get some recordings by every group in a single query
+        toGroups = [mgPair['group'] for fromGroup, mgPair in fromGroupPairs]
+        recsByGroup = db.getRecordingsByArtists(toGroups,
+                recsPerMemberGroupPair)
         threads = []
-        for fromGroup in fromGroups:
-            memberGroupPairs = db.getGroupsWithMembersInCommon(fromGroup)
-            # Iterate member-group pairs and get some recordings to make Threads
-            for mgPair in memberGroupPairs:
-                toRecs = db.getRecordingsByArtist(mgPair['group'], 
-                        select=recsPerMemberGroupPair)
-                # Make a Thread for each member-group-recording combination
-                thisPairThreads = ThreadByGroupWithMembersInCommon.makeThreads(
-                        db, fromKnot, toRecs, fromGroup, mgPair['group'],
-                        mgPair['member'])
-                threads += thisPairThreads
+        # Iterate groups and take their recordings to make Threads
+        for fromGroup, mgPair in fromGroupPairs:
+            toRecs = recsByGroup[mgPair['group'].gid]
+            # Make a Thread for each group-recording combination
+            thisPairThreads = ThreadByGroupWithMembersInCommon.makeThreads(
+                    db, fromKnot, toRecs, fromGroup, mgPair['group'],
+                    mgPair['members'])
+            threads += thisPairThreads
         return threads
+
+    # Returns a string naming the members in common
+    def renderMembers(self):
+        if len(self.membersInCommon) == 1:
+            renderString = 'group member '
+        else:
+            renderString = 'group members '
+        renderString += CreditedArtists(self.membersInCommon).renderNames()
+        return renderString
     
-    def render(self):
+    def renderThread(self):
         if len(self.toKnot.creditedArtists.artistList) == 1:
-            renderString = '"' + self.toKnot.rec.name + '" by ' + \
-                       self.toGroup.name + ', that had group member ' +\
-                       self.memberInCommon.name + ' in common with ' +\
-                       self.fromGroup.name
+            renderString = '"%s" by %s, that had %s in common ' \
+                           'with %s' % (self.toKnot.rec.name,
+                                   self.toGroup.name,
+                                   self.renderMembers(),
+                                   self.fromGroup.name)
         else:
-            renderString = '"' + self.toKnot.rec.name + '" by ' + \
-                       self.toKnot.creditedArtists.render() + '. ' +\
-                       self.toGroup.name + ' had group member ' +\
-                       self.memberInCommon.name + ' in common with ' +\
-                       self.fromGroup.name
+            renderString = '"%s" by %s. %s had %s in common ' \
+                           'with %s' % (self.toKnot.rec.name,
+                                   self.toKnot.creditedArtists.renderNames(),
+                                   self.toGroup.name,
+                                   self.renderMembers(),
+                                   self.fromGroup.name)
         return renderString.encode('utf-8')
     
-    def serialize(self):
+    def serialize(self, knotStructs=None):
         struct = {
                 'type': 'ThreadByGroupWithMembersInCommon',
-                'fromKnot': self.fromKnot.serialize(),
-                'toKnot': self.toKnot.serialize(),
+                'fromKnot': self.serializeKnot(self.fromKnot, knotStructs),
+                'toKnot': self.serializeKnot(self.toKnot, knotStructs),
                 'id': self.id,
                 'fromGroup': self.fromGroup.name,
                 'toGroup': self.toGroup.name,
-                'memberInCommon': self.memberInCommon.name
+                'memberInCommon': CreditedArtists(
+                    self.membersInCommon).renderNames()
                 }
         return struct
 
@@ -244,42 +387,24 @@ class ThreadByGroupWithMembersInCommon(Thread):
     # is a Group
     @staticmethod
     def isApplicable(db, fromKnot):
-        fromRec = fromKnot.rec
         fromArtists = fromKnot.creditedArtists
-        for cArtist in fromArtists.artistList:
-            if db.isGroup(cArtist):
-                return True
-        return False
+        return any(db.isGroup(cArtist) for cArtist in fromArtists.artistList)
     
-    # Returning a random thread for now
-    @staticmethod
-    def rank(threads, nResults):
-        best = np.random.choice(threads, nResults).tolist()
-        return best
-
     # Returns a list of Threads given a starting Knot, a list of ending
     # Recordings and the extra information for each of them: from/to groups and
-    # member in common
+    # members in common
     @staticmethod
-    def makeThreads(db, fromKnot, toRecs, fromGroup, toGroup, member):
-        threads = []
-        for toRec in toRecs:
-            toCreditedArtistsList = db.getArtistsByRecording(toRec, 'ALL')
-            toCreditedArtists = CreditedArtists(toCreditedArtistsList)
-            toKnot = Knot(toRec, toCreditedArtists, pKnot=fromKnot)
-            newThread = ThreadByGroupWithMembersInCommon(
-                    fromKnot, toKnot, 
-                    fromGroup, toGroup,
-                    member)
-            toKnot.inThread = newThread
-            threads.append(newThread)
-        return threads
+    def makeThreads(db, fromKnot, toRecs, fromGroup, toGroup, members):
+        toKnots = Thread.buildToKnots(db, fromKnot, toRecs)
+        return Thread.linkKnots(ThreadByGroupWithMembersInCommon,
+                fromKnot, toKnots, fromGroup, toGroup, members)
 
 """
 ThreadByGroupMemberSoloAct: A song by a group member's solo act
 """
 class ThreadByGroupMemberSoloAct(Thread):
     descText = 'A song by a member of the same band playing solo'
+    __slots__ = ('fromGroup', 'memberInCommon', 'memberPerformsAs')
     # This Thread type additionally stores the name of the previous group, the
     # member in common, and the member's performing name (if it applies)
     def __init__(self, fKnot, tKnot, fGroup, member, mPerformsAs=None):
@@ -295,38 +420,40 @@ class ThreadByGroupMemberSoloAct(Thread):
         fromGroups = [artist for artist in fromArtists.artistList
                 if db.isGroup(artist)]
         # Get solo Artists related to this Group's members
+        fromGroupActs = [(fromGroup, memberAct) for fromGroup in fromGroups
+                for memberAct in db.getMembersSoloActsByGroup(fromGroup)]
+        # Get some recordings by every act in a single query
+        acts = [memberAct['performsAs'] for fromGroup, memberAct
+                in fromGroupActs]
+        recsByAct = db.getRecordingsByArtists(acts, recsPerMemberActPair)
         threads = []
-        for fromGroup in fromGroups:
-            memberActs = db.getMembersSoloActsByGroup(fromGroup)
-            # Iterate acts and get some recordings to make Threads
-            for memberAct in memberActs:
-                toRecs = db.getRecordingsByArtist(memberAct['performsAs'], 
-                        select=recsPerMemberActPair)
-                thisMemberActThreads = ThreadByGroupMemberSoloAct.makeThreads(
-                        db, fromKnot, toRecs, fromGroup, 
-                        memberAct['member'], memberAct['performsAs'])
-                threads += thisMemberActThreads
+        # Iterate acts and take their recordings to make Threads
+        for fromGroup, memberAct in fromGroupActs:
+            toRecs = recsByAct[memberAct['performsAs'].gid]
+            thisMemberActThreads = ThreadByGroupMemberSoloAct.makeThreads(
+                    db, fromKnot, toRecs, fromGroup,
+                    memberAct['member'], memberAct['performsAs'])
+            threads += thisMemberActThreads
         return threads
     
-    def render(self):
+    def renderThread(self):
         if len(self.toKnot.creditedArtists.artistList) == 1:
-            renderString = '"' + self.toKnot.rec.name + '" by ' +\
-                   self.fromGroup.name + ' member ' +\
-                   self.memberInCommon.name
+            renderString = '"%s" by %s member %s' % (self.toKnot.rec.name,
+                    self.fromGroup.name, self.memberInCommon.name)
         else:
-            renderString = '"' + self.toKnot.rec.name + '" by ' +\
-                   self.toKnot.creditedArtists.render() + '. ' +\
-                   self.fromGroup.name + ' had member ' +\
-                   self.memberInCommon.name
+            renderString = '"%s" by %s. %s had member %s' % (
+                    self.toKnot.rec.name,
+                    self.toKnot.creditedArtists.renderNames(),
+                    self.fromGroup.name, self.memberInCommon.name)
         if self.memberInCommon.name != self.memberPerformsAs.name:
-            renderString += ', who performs as ' + self.memberPerformsAs.name
+            renderString += ', who performs as %s' % self.memberPerformsAs.name
         return renderString.encode('utf-8')
     
-    def serialize(self):
+    def serialize(self, knotStructs=None):
         struct = {
                 'type': 'ThreadByGroupMemberSoloAct',
-                'fromKnot': self.fromKnot.serialize(),
-                'toKnot': self.toKnot.serialize(),
+                'fromKnot': self.serializeKnot(self.fromKnot, knotStructs),
+                'toKnot': self.serializeKnot(self.toKnot, knotStructs),
                 'id': self.id,
                 'fromGroup': self.fromGroup.name,
                 'memberInCommon': self.memberInCommon.name
@@ -336,42 +463,21 @@ class ThreadByGroupMemberSoloAct(Thread):
         else:
             struct['memberPerformsAs'] = ''
         return struct
-        return struct
 
     # This type of Thread only applies if the artist of the current Knot
     # is a Group
     @staticmethod
     def isApplicable(db, fromKnot):
-        fromRec = fromKnot.rec
         fromArtists = fromKnot.creditedArtists
-        for cArtist in fromArtists.artistList:
-            if db.isGroup(cArtist):
-                return True
-        return False
+        return any(db.isGroup(cArtist) for cArtist in fromArtists.artistList)
     
-    # Returning a random thread for now
-    @staticmethod
-    def rank(threads, nResults):
-        best = np.random.choice(threads, nResults).tolist()
-        return best
-
     # Returns a list of Threads given a starting Knot, a list of Recordings and
     # their respective group, member in common and performing name (if any)
     @staticmethod
     def makeThreads(db, fromKnot, toRecs, fromGroup, member, performsAs):
-        threads = []
-        for toRec in toRecs:
-            toCreditedArtistsList = db.getArtistsByRecording(toRec, 'ALL')
-            toCreditedArtists = CreditedArtists(toCreditedArtistsList)
-            toKnot = Knot(toRec, toCreditedArtists, pKnot=fromKnot)
-            newThread = ThreadByGroupMemberSoloAct(
-                    fromKnot, toKnot,
-                    fromGroup, 
-                    member,
-                    performsAs)
-            toKnot.inThread = newThread
-            threads.append(newThread)
-        return threads
+        toKnots = Thread.buildToKnots(db, fromKnot, toRecs)
+        return Thread.linkKnots(ThreadByGroupMemberSoloAct,
+                fromKnot, toKnots, fromGroup, member, performsAs)
 
 
 
@@ -381,6 +487,7 @@ Reciprocal of ThreadByGroupMemberSoloAct
 """
 class ThreadByGroupPersonIsMemberOf(Thread):
     descText = 'A song by a band that the same artist was a member of'
+    __slots__ = ('fromPerson', 'toGroup', 'memberPerformsAs')
     # This Thread type additionally stores the name of the previous person, the
     # name of the band, and the person's performing name (if it applies)
     def __init__(self, fKnot, tKnot, fPerson, tGroup, mPerformsAs=None):
@@ -398,40 +505,55 @@ class ThreadByGroupPersonIsMemberOf(Thread):
         fromRec = fromKnot.rec
         fromArtists = [a for a in fromKnot.creditedArtists.artistList \
                 if db.isPerson(a) or db.isSinglePersonAct(a)]
-        threads = []
+        # Sort out artist and person identities for the link
+        identities = []
         for fromArtist in fromArtists:
-            toGroups = []
-            # Sort out artist and person identities for the link
             if db.isSinglePersonAct(fromArtist):
-                mPerformsAs = fromArtist
-                fromPerson = db.getPersonBySinglePersonAct(fromArtist)
-                toGroups += db.getGroupsByMember(mPerformsAs, 'ALL')
+                identities.append(
+                        (db.getPersonBySinglePersonAct(fromArtist), fromArtist))
             else:
-                mPerformsAs = None
-                fromPerson = fromArtist
-            # Get groups this person played in, get recordings and make threads
-            toGroups += db.getGroupsByMember(fromPerson, 'ALL')
-            for toGroup in toGroups:
-                toRecs = db.getRecordingsByArtist(toGroup,
-                        recsPerPersonGroupPair)
-                thisGroupThreads = ThreadByGroupPersonIsMemberOf.makeThreads(
-                        db, fromKnot, toRecs, fromPerson, toGroup, mPerformsAs)
-                threads += thisGroupThreads
+                identities.append((fromArtist, None))
+        # Get the groups that every person and act played in at once
+        members = [fromPerson for fromPerson, mPerformsAs in identities] +\
+                  [mPerformsAs for fromPerson, mPerformsAs in identities
+                   if mPerformsAs]
+        groupsByMember = db.getGroupsByMembers(members)
+        personGroups = []
+        for fromPerson, mPerformsAs in identities:
+            toGroups = []
+            if mPerformsAs:
+                toGroups += groupsByMember[mPerformsAs.gid]
+            toGroups += groupsByMember[fromPerson.gid]
+            # A group may be linked both to the act and to the person behind
+            # it, or to the same member more than once, but it only makes
+            # one set of Threads
+            toGroups = OrderedDict((g.gid, g) for g in toGroups).values()
+            personGroups += [(fromPerson, toGroup, mPerformsAs)
+                    for toGroup in toGroups]
+        # Get some recordings by every group in a single query
+        recsByGroup = db.getRecordingsByArtists(
+                [toGroup for fromPerson, toGroup, mPerformsAs in personGroups],
+                recsPerPersonGroupPair)
+        threads = []
+        for fromPerson, toGroup, mPerformsAs in personGroups:
+            toRecs = recsByGroup[toGroup.gid]
+            thisGroupThreads = ThreadByGroupPersonIsMemberOf.makeThreads(
+                    db, fromKnot, toRecs, fromPerson, toGroup, mPerformsAs)
+            threads += thisGroupThreads
         return threads
     
-    def render(self):
-        renderString = '"' + self.toKnot.rec.name + '" by ' +\
-                self.toGroup.name + '. This band had member ' +\
-            self.fromPerson.name 
+    def renderThread(self):
+        renderString = '"%s" by %s. This band had member %s' % (
+                self.toKnot.rec.name, self.toGroup.name, self.fromPerson.name)
         if self.memberPerformsAs:
-            renderString += ', who performs as ' + self.memberPerformsAs.name
+            renderString += ', who performs as %s' % self.memberPerformsAs.name
         return renderString.encode('utf-8')
 
-    def serialize(self):
+    def serialize(self, knotStructs=None):
         struct = {
                 'type': 'ThreadByGroupPersonIsMemberOf',
-                'fromKnot': self.fromKnot.serialize(),
-                'toKnot': self.toKnot.serialize(),
+                'fromKnot': self.serializeKnot(self.fromKnot, knotStructs),
+                'toKnot': self.serializeKnot(self.toKnot, knotStructs),
                 'id': self.id,
                 'fromPerson': self.fromPerson.name,
                 'toGroup': self.toGroup.name,
@@ -446,18 +568,9 @@ class ThreadByGroupPersonIsMemberOf(Thread):
     # is a Person or a single-Person act
     @staticmethod
     def isApplicable(db, fromKnot):
-        fromRec = fromKnot.rec
         fromArtists = fromKnot.creditedArtists
-        for cArtist in fromArtists.artistList:
-            if db.isPerson(cArtist) or db.isSinglePersonAct(cArtist):
-                return True
-        return False
-
-    # Returning a random thread for now
-    @staticmethod
-    def rank(threads, nResults):
-        best = np.random.choice(threads, nResults).tolist()
-        return best
+        return any(db.isPerson(cArtist) or db.isSinglePersonAct(cArtist)
+                   for cArtist in fromArtists.artistList)
 
     # Returns a list of Threads given a starting Knot, a list of Recordings,
     # and the extra info for each Recording: the name of the Person that links
@@ -465,16 +578,9 @@ class ThreadByGroupPersonIsMemberOf(Thread):
     # they played.
     @staticmethod
     def makeThreads(db, fromKnot, toRecs, fromPerson, toGroup, mPerformsAs):
-        threads = []
-        for toRec in toRecs:
-            toCreditedArtistList = db.getArtistsByRecording(toRec, 'ALL')
-            toCreditedArtists = CreditedArtists(toCreditedArtistList)
-            toKnot = Knot(toRec, toCreditedArtists, pKnot=fromKnot)
-            newThread = ThreadByGroupPersonIsMemberOf(fromKnot, toKnot,
-                    fromPerson, toGroup, mPerformsAs)
-            toKnot.inThread = newThread
-            threads.append(newThread)
-        return threads
+        toKnots = Thread.buildToKnots(db, fromKnot, toRecs)
+        return Thread.linkKnots(ThreadByGroupPersonIsMemberOf,
+                fromKnot, toKnots, fromPerson, toGroup, mPerformsAs)
 
 """
 ThreadByArtistWithFestivalInCommon: a song by an artist that played in the same
@@ -482,6 +588,7 @@ event as the previous one
 """
 class ThreadByArtistWithFestivalInCommon(Thread):
     descText = 'A song by an artist that played in the same festival'
+    __slots__ = ('fromArtist', 'toArtist', 'festival')
     # This Thread type additionally stores the two artists, and the event in
     # common
     def __init__(self, fKnot, tKnot, fArtist, tArtist, festival):
@@ -506,42 +613,48 @@ class ThreadByArtistWithFestivalInCommon(Thread):
     def getAllPossibleThreads(db, fromKnot, recsPerArtist):
         fromRec = fromKnot.rec
         fromArtists = fromKnot.creditedArtists
-        threads = []
+        festivalArtists = []
         for fromArtist in fromArtists.artistList:
             thisArtistFestivals = db.getEventsByArtist(fromArtist, 'ALL',
                 ['Festival'])
             for festival in thisArtistFestivals:
                 majorFestival = db.getLargestEventByPart(festival)
                 thisFestivalArtists = db.getArtistsByEvent(festival, 'ALL')
-                thisFestivalArtists = [a for a in thisFestivalArtists \
-                                        if a is not fromArtist]
-                for festivalArtist in thisFestivalArtists:
-                    toRecs = db.getRecordingsByArtist(festivalArtist,
-                            recsPerArtist)
-                    thisArtistThreads = \
-                        ThreadByArtistWithFestivalInCommon.makeThreads( 
-                                db,
-                                fromKnot, toRecs, 
-                                fromArtist, festivalArtist, majorFestival)
-                    threads += thisArtistThreads
+                festivalArtists += [(fromArtist, a, majorFestival)
+                        for a in thisFestivalArtists
+                        if a.gid != fromArtist.gid]
+        # Get some recordings by every festival artist in a single query
+        recsByArtist = db.getRecordingsByArtists(
+                [a for fromArtist, a, majorFestival in festivalArtists],
+                recsPerArtist)
+        threads = []
+        for fromArtist, festivalArtist, majorFestival in festivalArtists:
+            toRecs = recsByArtist[festivalArtist.gid]
+            thisArtistThreads = \
+                ThreadByArtistWithFestivalInCommon.makeThreads(
+                        db,
+                        fromKnot, toRecs,
+                        fromArtist, festivalArtist, majorFestival)
+            threads += thisArtistThreads
         return threads
 
-    def render(self):
-        renderString = '"' + self.toKnot.rec.name + '" by '
+    def renderThread(self):
         if len(self.toKnot.creditedArtists.artistList) > 1:
-            renderString += self.toKnot.creditedArtists.render() + '. ' +\
-                self.toArtist.name + ' '
+            artistsString = '%s. %s' % (
+                    self.toKnot.creditedArtists.renderNames(),
+                    self.toArtist.name)
         else:
-            renderString += self.toArtist.name + ', who '
-        renderString += 'played in festival ' + self.festival.name +\
-            ' with ' + self.fromArtist.name
+            artistsString = '%s, who' % self.toArtist.name
+        renderString = '"%s" by %s played in festival %s with %s' % (
+                self.toKnot.rec.name, artistsString, self.festival.name,
+                self.fromArtist.name)
         return renderString.encode('utf-8')
 
-    def serialize(self):
+    def serialize(self, knotStructs=None):
         struct = {
                 'type': 'ThreadByArtistWithFestivalInCommon',
-                'fromKnot': self.fromKnot.serialize(),
-                'toKnot': self.toKnot.serialize(),
+                'fromKnot': self.serializeKnot(self.fromKnot, knotStructs),
+                'toKnot': self.serializeKnot(self.toKnot, knotStructs),
                 'id': self.id,
                 'fromArtist': self.fromArtist.name,
                 'toArtist': self.toArtist.name,
@@ -554,26 +667,138 @@ class ThreadByArtistWithFestivalInCommon(Thread):
     def isApplicable(db, fromKnot):
         return True
 
-    # Returning a random thread for now
-    @staticmethod
-    def rank(threads, nResults):
-        best = np.random.choice(threads, nResults).tolist()
-        return best
-
     # Returns a list of Threads given a starting Knot, a list of Recordings and
     # the additional info: starting and ending Artists and the Festival Event
     # in which they both played.
     @staticmethod
     def makeThreads(db, fromKnot, toRecs, fArtist, tArtist, festival):
-        threads = []
-        for toRec in toRecs:
-            toCreditedArtistList = db.getArtistsByRecording(toRec, 'ALL')
-            toCreditedArtists = CreditedArtists(toCreditedArtistList)
-            toKnot = Knot(toRec, toCreditedArtists, pKnot=fromKnot)
-            thisThread = ThreadByArtistWithFestivalInCommon( 
-                    fromKnot, toKnot, fArtist, tArtist, festival)
-            threads.append(thisThread)
-        return threads
+        toKnots = Thread.buildToKnots(db, fromKnot, toRecs)
+        return Thread.linkKnots(ThreadByArtistWithFestivalInCommon,
+                fromKnot, toKnots, fArtist, tArtist, festival)
+
+# All the Thread types and their descriptions, in the order they are offered.
+# They are listed once, here, after every Thread type has been defined
+ALL_THREAD_TYPES = tuple(Thread.__subclasses__())
+THREAD_TYPE_DESCS = tuple(tType.descText for tType in ALL_THREAD_TYPES)
+
+
+"""
+A RecordingStub is a read-only view of a MB Recording, holding only the
+columns that Knots use and the Artists that the Recording is credited to.
+Exploring builds many of them, so they are fetched as plain rows rather than
+ORM objects.
+"""
+RecordingStub = namedtuple('RecordingStub', ['id', 'gid', 'name', 'artists'])
+
+
+"""
+An ArtistStub is a read-only view of a MB Artist, holding only the columns that
+Knots and Threads use and the name of the Artist's type. Unlike ORM objects,
+stubs do not belong to a session, so they can be cached and shared by every
+session of the AriadneDB.
+"""
+ArtistStub = namedtuple('ArtistStub', ['id', 'gid', 'name', 'typeName'])
+
+
+"""
+An EventStub is a read-only view of a MB Event, holding only the columns that
+Threads use
+"""
+EventStub = namedtuple('EventStub', ['id', 'gid', 'name'])
+
+
+"""
+A QueryCache memoizes the results of AriadneDB queries. Results are keyed by
+the query method, the GID of the entity it was called with and the select
+value. It holds at most maxSize results, dropping the least recently used ones.
+"""
+class QueryCache(object):
+    def __init__(self, maxSize=4096):
+        self.maxSize = maxSize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Thread types are explored concurrently, so changes to the cache are
+        # serialized
+        self.lock = threading.RLock()
+
+    # Returns whether a key is cached and its cached result, marking it as the
+    # most recently used
+    def get(self, key):
+        with self.lock:
+            if key not in self.results:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            result = self.results.pop(key)
+            self.results[key] = result
+            return True, result
+
+    # Stores a result, dropping the least recently used one if full
+    def set(self, key, result):
+        with self.lock:
+            self.results.pop(key, None)
+            self.results[key] = result
+            if len(self.results) > self.maxSize:
+                self.results.popitem(last=False)
+
+    # Returns the cached result for a key, computing and storing it if missing
+    def lookup(self, key, compute):
+        isCached, result = self.get(key)
+        if not isCached:
+            result = compute()
+            self.set(key, result)
+        return result
+
+    # Drops the cached result for a key, if there is one
+    def discard(self, key):
+        with self.lock:
+            self.results.pop(key, None)
+
+    # Drops all cached results
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+    # Drops the cached results of queries on the entity with the given GID
+    def clearEntity(self, gid):
+        with self.lock:
+            for key in [k for k in self.results if k[1] == gid]:
+                del self.results[key]
+
+    # Returns usage statistics of the cache
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                    'size': len(self.results),
+                    'maxSize': self.maxSize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hitRate': float(self.hits) / lookups if lookups else 0.0
+                    }
+
+# Decorates an AriadneDB method that queries by entity and select value so that
+# its results are served from the AriadneDB's QueryCache when available
+# Streamed results can only be iterated once, so they are never cached
+def cachedQuery(method):
+    @functools.wraps(method)
+    def cachedMethod(self, entity, select):
+        if select == 'STREAM':
+            return method(self, entity, select)
+        key = (method.__name__, entity.gid, select)
+        return self.cache.lookup(key, lambda: method(self, entity, select))
+    return cachedMethod
+
+# Decorates an AriadneDB method that checks a property of an entity, or looks
+# up a single related one, so that its result is served from the AriadneDB's
+# QueryCache when available
+def cachedCheck(method):
+    @functools.wraps(method)
+    def cachedMethod(self, entity):
+        key = (method.__name__, entity.gid)
+        return self.cache.lookup(key, lambda: method(self, entity))
+    return cachedMethod
 
 
 """
@@ -581,137 +806,615 @@ An AriadneDB wraps the connection to the MusicBrainz database and provides
 useful functions to access it
 """
 class AriadneDB(object):
-    def __init__(self, connString, echo):
-        engine = create_engine(connString, echo=echo)
-        Session = sessionmaker(bind=engine)
-        self.sess = Session()
+    # The engine keeps the compiled SQL of the statements it runs, so that
+    # repeated queries skip compilation. Its cache is sized above the number
+    # of distinct statements that AriadneDB builds.
+    # Connections are pooled: they are checked before being reused, and
+    # recycled before the server drops them for being idle. The most recently
+    # used one is reused first, so that a few connections stay warm and the
+    # overflow ones are left idle
+    def __init__(self, connString, echo, queryCacheSize=1200, poolSize=20,
+            maxOverflow=10, poolRecycle=3600, poolTimeout=30, cacheSize=4096):
+        self.engine = create_engine(connString, echo=echo,
+                query_cache_size=queryCacheSize,
+                pool_size=poolSize,
+                max_overflow=maxOverflow,
+                pool_pre_ping=True,
+                pool_use_lifo=True,
+                pool_recycle=poolRecycle,
+                pool_timeout=poolTimeout)
+        # Each thread using the AriadneDB gets its own session, so that
+        # queries can be run concurrently on separate pooled connections
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        # Results of the queries that are repeated along an exploration. Worker
+        # sessions are removed once they are done, so results are cached as
+        # stubs that do not belong to any session, never as ORM objects
+        self.cache = QueryCache(cacheSize)
+        # Single shared instance of the Artists loaded so far, by Artist ID
+        # The AriadneDB is shared by every user, so only the most recently used
+        # ones are kept
+        self.artistsByID = QueryCache(cacheSize)
+        # IDs of the Artist-Artist link types that Threads follow, so that links
+        # can be filtered by type without joining the link type table
+        self.linkTypeIDs = dict((name, self.getArtistLinkTypeID(name))
+                                for name in self.artistLinkTypeNames)
+        # Queries run at every exploration step are built only once, and bound
+        # to the entity being looked up on each call
+        self.prebuiltQueries = self.buildQueries()
+
+    # Names of the Artist-Artist link types that Threads follow
+    artistLinkTypeNames = ('member of band', 'is person')
+
+    # Returns the ID of the Artist-Artist link type with the given name
+    def getArtistLinkTypeID(self, linkTypeName):
+        query = self.sess.query(mb.LinkType.id)\
+                         .filter(mb.LinkType.name == linkTypeName)\
+                         .filter(mb.LinkType.entity_type0 == 'artist')\
+                         .filter(mb.LinkType.entity_type1 == 'artist')
+        return query.scalar()
+
+    # Returns the session of the calling thread
+    @property
+    def sess(self):
+        return self.Session()
+
+    # Closes the session of the calling thread, returning its connection to
+    # the pool
+    def close(self):
+        self.Session.remove()
+
+    # Builds the queries run at every exploration step, filtering on bound
+    # parameters instead of literal values
+    def buildQueries(self):
+        recordingsByArtist = self.sess.query(*self.recordingStubColumns())\
+                         .join(mb.ArtistCreditName,
+                               mb.ArtistCreditName.artist_credit_id ==
+                               mb.Recording.artist_credit_id)\
+                         .filter(mb.ArtistCreditName.artist_id ==
+                                 bindparam('artistID'))\
+                         .order_by(mb.Recording.id)
+        membersByGroup = self.sess.query(mb.LinkArtistArtist)\
+                         .join(mb.Link)\
+                         .filter(mb.LinkArtistArtist.entity1_id ==
+                                 bindparam('artistID'))\
+                         .filter(mb.Link.link_type_id ==
+                                 self.linkTypeIDs['member of band'])\
+                         .options(joinedload(mb.LinkArtistArtist.entity0)
+                                  .joinedload(mb.Artist.type))
+        groupsByMember = self.sess.query(mb.LinkArtistArtist)\
+                         .join(mb.Link)\
+                         .filter(mb.LinkArtistArtist.entity0_id ==
+                                 bindparam('artistID'))\
+                         .filter(mb.Link.link_type_id ==
+                                 self.linkTypeIDs['member of band'])\
+                         .options(joinedload(mb.LinkArtistArtist.entity1)
+                                  .joinedload(mb.Artist.type))
+        groupsByMembers = self.sess.query(mb.LinkArtistArtist)\
+                         .join(mb.Link)\
+                         .filter(mb.LinkArtistArtist.entity0_id.in_(
+                             bindparam('artistIDs', expanding=True)))\
+                         .filter(mb.Link.link_type_id ==
+                                 self.linkTypeIDs['member of band'])\
+                         .options(joinedload(mb.LinkArtistArtist.entity1)
+                                  .joinedload(mb.Artist.type))
+        artistsPeoplePerformAs = self.sess.query(mb.LinkArtistArtist)\
+                         .join(mb.Link)\
+                         .filter(mb.LinkArtistArtist.entity0_id.in_(
+                             bindparam('artistIDs', expanding=True)))\
+                         .filter(mb.Link.link_type_id ==
+                                 self.linkTypeIDs['is person'])\
+                         .options(joinedload(mb.LinkArtistArtist.entity1)
+                                  .joinedload(mb.Artist.type))
+        creditHasRecordings = exists().where(
+                mb.Recording.artist_credit_id ==
+                mb.ArtistCreditName.artist_credit_id)
+        artistsWithRecordings = self.sess.query(mb.ArtistCreditName.artist_id)\
+                         .filter(mb.ArtistCreditName.artist_id.in_(
+                             bindparam('artistIDs', expanding=True)))\
+                         .filter(creditHasRecordings)\
+                         .distinct()
+        artistRecordings = self.sess.query(mb.Recording.id)\
+                         .join(mb.ArtistCreditName,
+                               mb.ArtistCreditName.artist_credit_id ==
+                               mb.Recording.artist_credit_id)\
+                         .filter(mb.ArtistCreditName.artist_id ==
+                                 bindparam('artistID'))
+        artistHasRecordings = self.sess.query(artistRecordings.exists())
+        artistsByCredits = self.sess.query(
+                                mb.ArtistCreditName.artist_credit_id,
+                                mb.Artist)\
+                         .join(mb.Artist)\
+                         .filter(mb.ArtistCreditName.artist_credit_id.in_(
+                             bindparam('creditIDs', expanding=True)))\
+                         .order_by(mb.ArtistCreditName.artist_credit_id,
+                                   mb.ArtistCreditName.position)\
+                         .options(joinedload(mb.Artist.type))
+        artistsPersonPerformsAs = self.sess.query(mb.LinkArtistArtist)\
+                         .join(mb.Link)\
+                         .filter(mb.LinkArtistArtist.entity0_id ==
+                                 bindparam('artistID'))\
+                         .filter(mb.Link.link_type_id ==
+                                 self.linkTypeIDs['is person'])\
+                         .options(joinedload(mb.LinkArtistArtist.entity1)
+                                  .joinedload(mb.Artist.type))
+        personBySinglePersonAct = self.sess.query(mb.LinkArtistArtist)\
+                         .join(mb.Link)\
+                         .filter(mb.LinkArtistArtist.entity1_id ==
+                                 bindparam('artistID'))\
+                         .filter(mb.Link.link_type_id ==
+                                 self.linkTypeIDs['is person'])\
+                         .options(joinedload(mb.LinkArtistArtist.entity0)
+                                  .joinedload(mb.Artist.type))
+        eventsByArtist = self.sess.query(mb.Event)\
+                         .join(mb.LinkArtistEvent,
+                               mb.LinkArtistEvent.entity1_id == mb.Event.id)\
+                         .filter(mb.LinkArtistEvent.entity0_id ==
+                                 bindparam('artistID'))
+        artistsByEvent = self.sess.query(mb.Artist)\
+                         .join(mb.LinkArtistEvent,
+                               mb.LinkArtistEvent.entity0_id == mb.Artist.id)\
+                         .filter(mb.LinkArtistEvent.entity1_id ==
+                                 bindparam('eventID'))\
+                         .options(joinedload(mb.Artist.type))
+        eventByPart = self.sess.query(mb.Event)\
+                         .join(mb.LinkEventEvent,
+                               mb.LinkEventEvent.entity0_id == mb.Event.id)\
+                         .filter(mb.LinkEventEvent.entity1_id ==
+                                 bindparam('eventID'))
+        recordingByGID = self.sess.query(*self.recordingStubColumns())\
+                         .filter(mb.Recording.gid == bindparam('gid'))
+        artistByGID = self.sess.query(mb.Artist)\
+                         .filter(mb.Artist.gid == bindparam('gid'))\
+                         .options(joinedload(mb.Artist.type))
+        return {
+                'recordingByGID': recordingByGID,
+                'artistByGID': artistByGID,
+                'recordingsByArtist': recordingsByArtist,
+                'membersByGroup': membersByGroup,
+                'groupsByMember': groupsByMember,
+                'groupsByMembers': groupsByMembers,
+                'artistHasRecordings': artistHasRecordings,
+                'artistsByCredits': artistsByCredits,
+                'artistsPersonPerformsAs': artistsPersonPerformsAs,
+                'artistsPeoplePerformAs': artistsPeoplePerformAs,
+                'artistsWithRecordings': artistsWithRecordings,
+                'personBySinglePersonAct': personBySinglePersonAct,
+                'eventsByArtist': eventsByArtist,
+                'artistsByEvent': artistsByEvent,
+                'eventByPart': eventByPart
+                }
+
+    # Returns a prebuilt query bound to the given parameters, to be run on the
+    # session of the calling thread
+    def prebuiltQuery(self, name, **params):
+        return self.prebuiltQueries[name].with_session(self.sess)\
+                                         .params(**params)
+
+    # Drops the cached query results on a given entity, or all of them if no
+    # entity is given, e.g. after the database has changed
+    def invalidate(self, entity=None):
+        if entity is None:
+            self.cache.clear()
+            self.artistsByID.clear()
+        else:
+            self.cache.clearEntity(entity.gid)
+            # IDs of other entities are from other tables, and may match that
+            # of an unrelated Artist
+            if isinstance(entity, (mb.Artist, ArtistStub)):
+                self.artistsByID.discard(entity.id)
+
+    # Returns the shared ArtistStub of an Artist object, making it if it is the
+    # first one loaded. Artists are loaded again by different queries and
+    # worker sessions, and this keeps Knots and Threads pointing at one
+    # instance of each
+    def shareArtist(self, artist):
+        if artist is None:
+            return None
+        # Held across the lookup, so that concurrent workers registering the
+        # same Artist end up sharing one instance
+        with self.artistsByID.lock:
+            return self.artistsByID.lookup(artist.id,
+                    lambda: self.makeArtistStub(artist))
+
+    # Makes an ArtistStub from an Artist object loaded along with its type
+    @staticmethod
+    def makeArtistStub(artist):
+        typeName = artist.type.name if artist.type else None
+        return ArtistStub(artist.id, artist.gid, artist.name, typeName)
+
+    # Makes an EventStub from an Event object
+    @staticmethod
+    def makeEventStub(event):
+        return EventStub(event.id, event.gid, event.name)
+
+    # Returns usage statistics of the query cache
+    def cacheStats(self):
+        return self.cache.stats()
+
+    # Returns a description of the state of the connection pool
+    def poolStatus(self):
+        return self.engine.pool.status()
     
+    # Number of rows fetched at a time when streaming results
+    streamBatchSize = 200
+
+    # Ways of fetching the results of a query for the named select values
+    # 'STREAM' returns an iterable that fetches rows in batches through a
+    # server-side cursor, so that large results are never held in memory
+    queryHandlers = {
+            'ALL': lambda query: query.all(),
+            'FIRST': lambda query: query.first(),
+            'STREAM': lambda query: query\
+                    .execution_options(stream_results=True)\
+                    .yield_per(AriadneDB.streamBatchSize)
+            }
+
+    # Ways of taking results from a fetched list for the named select values
+    listHandlers = {
+            'ALL': lambda items: items,
+            'FIRST': lambda items: items[0] if items else None,
+            'STREAM': lambda items: iter(items)
+            }
+
+    # Checks whether a select value is a maximum number of results. Booleans
+    # are ints too, but they are not valid limits
+    @staticmethod
+    def isLimit(select):
+        return isinstance(select, int) and not isinstance(select, bool)
+
     # Runs a query on the DB and returns the desired amount of results
     def queryDB(self, query, select):
-        if select == 'ALL':
-            results = query.all()
-        elif select == 'FIRST':
-            results = query.first()
-        elif type(select) == int:
-            results = query.limit(select).all()
-        else:
-            raise ValueError('Bad select value')
-        return results 
+        handler = self.queryHandlers.get(select)
+        if handler:
+            return handler(query)
+        if self.isLimit(select):
+            return query.limit(select).all()
+        raise ValueError('Bad select value')
+
+    # Returns the desired amount of results from an already fetched list
+    def selectFromList(self, items, select):
+        handler = self.listHandlers.get(select)
+        if handler:
+            return handler(items)
+        if self.isLimit(select):
+            return items[:select]
+        raise ValueError('Bad select value')
     
     # Checks whether an Artist is a Group
+    @cachedCheck
     def isGroup(self, artist):
-        return artist.type.name == 'Group'
+        return artist.typeName == 'Group'
     
     # Checks whether an Artist is a Person
+    @cachedCheck
     def isPerson(self, artist):
-        return artist.type.name == 'Person'
+        return artist.typeName == 'Person'
     
     # Checkes whether an Artist is a single-Person act
+    @cachedCheck
     def isSinglePersonAct(self, artist):
         return bool(self.getPersonBySinglePersonAct(artist))
 
     # Checks whether an Artist has any recordings credited to them
+    # Asks the DB with an EXISTS query, which stops at the first match and
+    # does not return any Recording rows
+    # The query is prebuilt in buildQueries
+    @cachedCheck
     def artistHasRecordings(self, artist):
-        recordings = self.getRecordingsByArtist(artist, 'FIRST')
-        if recordings:
-            return True
-        else:
-            return False
+        query = self.prebuiltQuery('artistHasRecordings', artistID=artist.id)
+        return query.scalar()
     
-    # Returns the Recording object that has the given GID
+    # Checks which Artists in a list have any recordings credited to them, as
+    # a dict keyed by Artist GID. The Artists missing from the QueryCache are
+    # all checked in a single query
+    def artistsHaveRecordings(self, artists):
+        haveRecordings, missingArtists = self.splitCachedBatch(
+                'artistHasRecordings', artists)
+        if not missingArtists:
+            return haveRecordings
+        query = self.prebuiltQuery('artistsWithRecordings',
+                artistIDs=list(missingArtists.keys()))
+        withRecordings = set(row.artist_id
+                             for row in self.queryDB(query, 'ALL'))
+        fetchedChecks = dict((artist.gid, artist.id in withRecordings)
+                             for artist in missingArtists.values())
+        self.cacheBatch('artistHasRecordings', fetchedChecks)
+        haveRecordings.update(fetchedChecks)
+        return haveRecordings
+    
+    # Returns the Recording that has the given GID, as a RecordingStub
+    # The same Recordings tend to be input again within a session, so they are
+    # served from the QueryCache once looked up
     def getRecordingByGID(self, gid):
-        query = self.sess.query(mb.Recording)\
-                         .filter(mb.Recording.gid == gid)
-        return self.queryDB(query, 'FIRST')
+        def queryRecording():
+            query = self.prebuiltQuery('recordingByGID', gid=gid)
+            row = self.queryDB(query, 'FIRST')
+            return self.makeRecordingStubs([row])[0] if row else None
+        return self.cache.lookup(('getRecordingByGID', gid), queryRecording)
 
-    # Returns the Artist object that has the given GID
+    # Returns the Artist that has the given GID, as an ArtistStub
+    # Artists are always loaded along with their type, since checking it is
+    # how they are told apart in isGroup and isPerson
     def getArtistByGID(self, gid):
-        query = self.sess.query(mb.Artist)\
-                         .filter(mb.Artist.gid == gid)
-        return self.queryDB(query, 'FIRST')
+        query = self.prebuiltQuery('artistByGID', gid=gid)
+        return self.shareArtist(self.queryDB(query, 'FIRST'))
+
+    # Splits a list of entities by whether the results of a cached single
+    # entity method are in the QueryCache, so that only the missing ones are
+    # queried in a batch. Returns the cached results keyed by entity GID, and
+    # the missing entities keyed by their integer ID
+    def splitCachedBatch(self, methodName, entities, *args):
+        cachedResults = {}
+        missingEntities = OrderedDict()
+        for entity in entities:
+            isCached, result = self.cache.get((methodName, entity.gid) + args)
+            if isCached:
+                cachedResults[entity.gid] = result
+            else:
+                missingEntities[entity.id] = entity
+        return cachedResults, missingEntities
+
+    # Stores the results of a batch query, keyed by entity GID, as those of a
+    # cached single entity method
+    def cacheBatch(self, methodName, resultsByGID, *args):
+        for gid, result in resultsByGID.items():
+            self.cache.set((methodName, gid) + args, result)
 
     # Returns the Artist object(s) linked to a given Recording
-    # Navigate from Artist table to Recording table through Credit tables,
-    # get entries with matching Recording GID
+    # RecordingStubs already carry their Artists. Otherwise, get the Artists
+    # named in the Recording's Artist Credit by its integer ID
+    @cachedQuery
     def getArtistsByRecording(self, rec, select):
-        query = self.sess.query(mb.Artist)\
-                         .join(mb.ArtistCreditName)\
-                         .join(mb.ArtistCredit)\
-                         .join(mb.Recording)\
-                         .filter(mb.Recording.gid == rec.gid)
-        return self.queryDB(query, select) 
+        if isinstance(rec, RecordingStub):
+            artists = list(rec.artists)
+        else:
+            creditID = rec.artist_credit_id
+            artists = self.getArtistsByCredits([creditID])[creditID]
+        return self.selectFromList(artists, select)
+
+    # Returns the Artists linked to each Recording in a list, as a dict keyed by
+    # Recording GID. RecordingStubs already carry their Artists, and those of
+    # any other Recordings are fetched in a single query
+    def getArtistsByRecordings(self, recs):
+        creditIDs = set(rec.artist_credit_id for rec in recs
+                if not isinstance(rec, RecordingStub))
+        artistsByCredit = self.getArtistsByCredits(creditIDs)
+        artistsByRec = {}
+        for rec in recs:
+            if isinstance(rec, RecordingStub):
+                artistsByRec[rec.gid] = list(rec.artists)
+            else:
+                artistsByRec[rec.gid] = artistsByCredit[rec.artist_credit_id]
+        return artistsByRec
+
+    # Returns the Artists of each of the given Artist Credit IDs, as a dict
+    # keyed by Artist Credit ID. Artists are sorted as they are credited
+    def getArtistsByCredits(self, creditIDs):
+        artistsByCredit = dict((creditID, []) for creditID in creditIDs)
+        if not creditIDs:
+            return artistsByCredit
+        query = self.prebuiltQuery('artistsByCredits',
+                creditIDs=list(artistsByCredit.keys()))
+        for creditID, artist in self.queryDB(query, 'ALL'):
+            artistsByCredit[creditID].append(self.shareArtist(artist))
+        return artistsByCredit
+
+    # Returns the Recording columns needed to build RecordingStubs
+    @staticmethod
+    def recordingStubColumns():
+        return [mb.Recording.id.label('id'),
+                mb.Recording.gid.label('gid'),
+                mb.Recording.name.label('name'),
+                mb.Recording.artist_credit_id.label('artistCreditID')]
+
+    # Makes RecordingStubs from a list of rows of Recording columns, fetching
+    # the credited Artists of all of them in a single query
+    def makeRecordingStubs(self, rows):
+        artistsByCredit = self.getArtistsByCredits(
+                set(row.artistCreditID for row in rows))
+        return [RecordingStub(row.id, row.gid, row.name,
+                    tuple(artistsByCredit[row.artistCreditID]))
+                for row in rows]
     
-    # Returns the Recording object(s) linked to a given Artist
-    # Navigate from Recording table to Artist table through Credit tables,
-    # get entries with matching Artist GID
+    # Returns the Recording(s) linked to a given Artist, as RecordingStubs
+    # Join Recordings to the names in their Artist Credit and keep those
+    # naming the given Artist. The Artist Credit and Artist tables themselves
+    # are not needed
+    # Recordings are sorted by ID so that limited results are stable, which
+    # also allows paging through them by the last ID seen
+    # The query is prebuilt in buildQueries
+    @cachedQuery
     def getRecordingsByArtist(self, artist, select):
-        query = self.sess.query(mb.Recording)\
-                                .join(mb.ArtistCredit)\
-                                .join(mb.ArtistCreditName)\
-                                .join(mb.Artist)\
-                                .filter(mb.Artist.gid == artist.gid)
-        return self.queryDB(query, select)
+        query = self.prebuiltQuery('recordingsByArtist', artistID=artist.id)
+        results = self.queryDB(query, select)
+        if select == 'FIRST':
+            return self.makeRecordingStubs([results])[0] if results else None
+        if select == 'STREAM':
+            return self.streamRecordingStubs(results)
+        return self.makeRecordingStubs(results)
+
+    # Makes RecordingStubs from streamed rows of Recording columns. Streamed
+    # rows can only be iterated once, so they are taken a batch at a time and
+    # the credited Artists of each batch are fetched in a single query
+    def streamRecordingStubs(self, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.streamBatchSize:
+                for rec in self.makeRecordingStubs(batch):
+                    yield rec
+                batch = []
+        for rec in self.makeRecordingStubs(batch):
+            yield rec
     
+    # Returns the Recordings linked to each Artist in a list, as a dict of
+    # RecordingStubs keyed by Artist GID
+    # Results are shared with getRecordingsByArtist through the QueryCache, so
+    # only the Artists missing from it are queried
+    def getRecordingsByArtists(self, artists, select):
+        if select != 'ALL' and not self.isLimit(select):
+            raise ValueError('Bad select value')
+        recsByArtist, missingArtists = self.splitCachedBatch(
+                'getRecordingsByArtist', artists, select)
+        fetchedRecs = self.queryRecordingsByArtists(missingArtists.values(),
+                select)
+        self.cacheBatch('getRecordingsByArtist', fetchedRecs, select)
+        recsByArtist.update(fetchedRecs)
+        return recsByArtist
+
+    # Queries the Recordings linked to each Artist in a list, as a dict of
+    # RecordingStubs keyed by Artist GID. The Recordings of all Artists are
+    # fetched in a single query, numbering them per Artist to keep at most
+    # `select` each
+    def queryRecordingsByArtists(self, artists, select):
+        recsByArtist = dict((artist.gid, []) for artist in artists)
+        if not artists:
+            return recsByArtist
+        artistGIDsByID = dict((artist.id, artist.gid) for artist in artists)
+        rowNumber = func.row_number().over(
+                partition_by=mb.ArtistCreditName.artist_id,
+                order_by=mb.Recording.id)
+        numberedRecs = self.sess.query(
+                                mb.Recording.id.label('recID'),
+                                mb.ArtistCreditName.artist_id.label('artistID'),
+                                rowNumber.label('rowNumber'))\
+                                .select_from(mb.Recording)\
+                                .join(mb.ArtistCreditName,
+                                    mb.ArtistCreditName.artist_credit_id ==
+                                    mb.Recording.artist_credit_id)\
+                                .filter(mb.ArtistCreditName.artist_id.in_(
+                                    artistGIDsByID.keys()))\
+                                .subquery()
+        query = self.sess.query(numberedRecs.c.artistID,
+                                *self.recordingStubColumns())\
+                         .select_from(mb.Recording)\
+                         .join(numberedRecs,
+                               numberedRecs.c.recID == mb.Recording.id)\
+                         .order_by(mb.Recording.id)
+        if self.isLimit(select):
+            query = query.filter(numberedRecs.c.rowNumber <= select)
+        rows = self.queryDB(query, 'ALL')
+        for row, rec in zip(rows, self.makeRecordingStubs(rows)):
+            recsByArtist[artistGIDsByID[row.artistID]].append(rec)
+        return recsByArtist
+
     # Returns the Person Artist(s) linked to a given Group Artist
+    @cachedQuery
     def getMembersByGroup(self, group, select):
-        query = self.sess.query(mb.LinkArtistArtist)\
-                         .join(mb.Link)\
-                         .join(mb.LinkType)\
-                         .filter(mb.LinkArtistArtist.entity1 == group)\
-                         .filter(mb.LinkType.name == 'member of band')
+        query = self.prebuiltQuery('membersByGroup', artistID=group.id)
         results = self.queryDB(query, select)
-        members = [link.entity0 for link in results]
+        members = [self.shareArtist(link.entity0) for link in results]
         return members
     
     # Returns the Group Artist(s) linked to a given Person Artist
+    @cachedQuery
     def getGroupsByMember(self, member, select):
-        query = self.sess.query(mb.LinkArtistArtist)\
-                         .join(mb.Link)\
-                         .join(mb.LinkType)\
-                         .filter(mb.LinkArtistArtist.entity0 == member)\
-                         .filter(mb.LinkType.name == 'member of band')
+        query = self.prebuiltQuery('groupsByMember', artistID=member.id)
         results = self.queryDB(query, select)
-        groups = [link.entity1 for link in results]
+        groups = [self.shareArtist(link.entity1) for link in results]
         return groups
+
+    # Returns all the Group Artists linked to each Person Artist in a list, as
+    # a dict keyed by Person GID
+    def getGroupsByMembers(self, members):
+        return self.getLinkedArtistsBatch('groupsByMembers',
+                'getGroupsByMember', members)
+
+    # Returns all the Artists that each Person in a list performs as, as a
+    # dict keyed by Person GID
+    def getArtistsPeoplePerformAs(self, people):
+        return self.getLinkedArtistsBatch('artistsPeoplePerformAs',
+                'getArtistsPersonPerformsAs', people)
+
+    # Runs a prebuilt query on the Artist-Artist links from a list of Artists,
+    # returning the Artists they link to as a dict keyed by linking Artist GID
+    # Results are shared through the QueryCache with the method that looks up
+    # a single Artist, so only the Artists missing from it are queried, all
+    # in a single query
+    def getLinkedArtistsBatch(self, queryName, methodName, artists):
+        linkedByArtist, missingArtists = self.splitCachedBatch(methodName,
+                artists, 'ALL')
+        if not missingArtists:
+            return linkedByArtist
+        fetchedArtists = dict((artist.gid, [])
+                              for artist in missingArtists.values())
+        query = self.prebuiltQuery(queryName,
+                artistIDs=list(missingArtists.keys()))
+        for link in self.queryDB(query, 'ALL'):
+            artistGID = missingArtists[link.entity0_id].gid
+            fetchedArtists[artistGID].append(self.shareArtist(link.entity1))
+        self.cacheBatch(methodName, fetchedArtists, 'ALL')
+        linkedByArtist.update(fetchedArtists)
+        return linkedByArtist
     
-    # Returns the Group Artist(s) with members in common with another Group
+    # Returns an aliased view of the Artist-Artist links of a given type, so
+    # that several of them can be joined within the same query
+    def aliasArtistLinksByType(self, linkTypeName):
+        links = self.sess.query(mb.LinkArtistArtist)\
+                         .join(mb.Link)\
+                         .filter(mb.Link.link_type_id ==
+                                 self.linkTypeIDs[linkTypeName])\
+                         .subquery()
+        return aliased(mb.LinkArtistArtist, links)
+
+    # Returns the Group Artist(s) with members in common with another Group,
+    # each with the list of members they have in common
+    # Joins the 'member of band' links with themselves on the shared member,
+    # so that all member-group pairs are fetched in a single query
     def getGroupsWithMembersInCommon(self, fromGroup):
-        groupMembers = self.getMembersByGroup(fromGroup, 'ALL')
-        # Iterate group members to find other groups, store them in pairs
-        memberGroupPairs = []
-        for member in groupMembers:
-            # Get groups in which this member played
-            membersGroups = self.getGroupsByMember(member, 'ALL')
-            # Keep them if they're not the same one we had before
-            for group in membersGroups:
-                if group.gid != fromGroup.gid:
-                    memberGroupPairs.append({'member': member, 'group': group})
-        return memberGroupPairs
+        fromGroupLink = self.aliasArtistLinksByType('member of band')
+        toGroupLink = self.aliasArtistLinksByType('member of band')
+        member = aliased(mb.Artist)
+        group = aliased(mb.Artist)
+        query = self.sess.query(member, group)\
+                         .select_from(fromGroupLink)\
+                         .join(toGroupLink, toGroupLink.entity0_id ==
+                                            fromGroupLink.entity0_id)\
+                         .join(member, member.id == fromGroupLink.entity0_id)\
+                         .join(group, group.id == toGroupLink.entity1_id)\
+                         .filter(fromGroupLink.entity1_id == fromGroup.id)\
+                         .filter(toGroupLink.entity1_id != fromGroup.id)\
+                         .options(joinedload(member.type),
+                                  joinedload(group.type))
+        results = self.queryDB(query, 'STREAM')
+        # Gather the members in common with each group, so that every group is
+        # only returned once. Groups are kept in the order they were found
+        # A member may be linked to the same group more than once (e.g. for
+        # separate periods), so pairs already seen are skipped
+        membersByGroup = OrderedDict()
+        seenPairs = set()
+        for member, group in results:
+            member = self.shareArtist(member)
+            group = self.shareArtist(group)
+            if (member.gid, group.gid) in seenPairs:
+                continue
+            seenPairs.add((member.gid, group.gid))
+            if group.gid not in membersByGroup:
+                membersByGroup[group.gid] = {'group': group, 'members': []}
+            membersByGroup[group.gid]['members'].append(member)
+        return list(membersByGroup.values())
     
     # Returns the Artist(s) that a Person performs as
+    @cachedQuery
     def getArtistsPersonPerformsAs(self, person, select):
-        query = self.sess.query(mb.LinkArtistArtist)\
-                         .join(mb.Link)\
-                         .join(mb.LinkType)\
-                         .filter(mb.LinkArtistArtist.entity0 == person)\
-                         .filter(mb.LinkType.name == 'is person')
+        query = self.prebuiltQuery('artistsPersonPerformsAs',
+                artistID=person.id)
         results = self.queryDB(query, select)
         if results:
-            artists = [link.entity1 for link in results]
+            artists = [self.shareArtist(link.entity1) for link in results]
         else:
             artists = []
         return artists
     
     # Returns the Person linked to a single-Person Artist
+    # Cached, since isSinglePersonAct looks the Person up too and callers
+    # usually check an Artist before getting its Person
+    @cachedCheck
     def getPersonBySinglePersonAct(self, act):
-        query = self.sess.query(mb.LinkArtistArtist)\
-                         .join(mb.Link)\
-                         .join(mb.LinkType)\
-                         .filter(mb.LinkArtistArtist.entity1 == act)\
-                         .filter(mb.LinkType.name == 'is person')
+        query = self.prebuiltQuery('personBySinglePersonAct', artistID=act.id)
         results = self.queryDB(query, 'FIRST')
         if results:
-            person = results.entity0
+            person = self.shareArtist(results.entity0)
         else:
             person = None
         return person
@@ -722,66 +1425,105 @@ class AriadneDB(object):
     # (e.g. Richard David James performs as Aphex Twin)
     def getMembersSoloActsByGroup(self, fromGroup):
         groupMembers = self.getMembersByGroup(fromGroup, 'ALL')
+        # Members linked to the group more than once are only looked up once,
+        # and each member-act pair is only returned once
+        members = OrderedDict((m.gid, m) for m in groupMembers).values()
+        # Get the acts of all members, and whether they have recordings of
+        # their own, in one query each
+        performsAsByMember = self.getArtistsPeoplePerformAs(members)
+        haveRecordings = self.artistsHaveRecordings(members)
         acts = []
+        seenPairs = set()
         # Iterate group members
-        for member in groupMembers:
+        for member in members:
             # Get acts this member performs as
-            memberPerformsAs = self.getArtistsPersonPerformsAs(member, 'ALL')
+            memberPerformsAs = performsAsByMember[member.gid]
+            # Add the member if they have their own recordings
+            if haveRecordings[member.gid]:
+                memberPerformsAs = memberPerformsAs + [member]
             for artist in memberPerformsAs:
+                if (member.gid, artist.gid) in seenPairs:
+                    continue
+                seenPairs.add((member.gid, artist.gid))
                 acts.append({'member': member, 'performsAs': artist})
-            # Add the member if they have their own recordings
-            if self.artistHasRecordings(member):
-                acts.append({'member': member, 'performsAs': member})
         return acts
 
-    # Returns the Events where a certain Artist performed.
+    # Returns the Events where a certain Artist performed, as EventStubs.
     # Optionally, restrict to a certain Event type
+    # Events are queried directly through their links, without loading the
+    # links themselves, and filtered by type in SQL
     def getEventsByArtist(self, fromArtist, select, eventTypeNames=[]):
-        query = self.sess.query(mb.LinkArtistEvent)\
-                         .filter(mb.LinkArtistEvent.entity0 == fromArtist)
-        artistEventLinks = self.queryDB(query, select)
-        events=[]
-        for eventTypeName in eventTypeNames:
-                events += [l.entity1 for l in artistEventLinks \
-                            if l.entity1.type and \
-                            l.entity1.type.name == eventTypeName]
-        if events and not eventTypeNames:
-            events = [l.entity1 for l in artistEventLinks]
-        return events
+        query = self.prebuiltQuery('eventsByArtist', artistID=fromArtist.id)
+        if eventTypeNames:
+            query = query.join(mb.EventType)\
+                         .filter(mb.EventType.name.in_(eventTypeNames))
+        events = self.queryDB(query, select)
+        if select == 'FIRST':
+            return self.makeEventStub(events) if events else None
+        return [self.makeEventStub(event) for event in events]
 
     # Returns the Artists that performed at a certain Event.
+    # Artists are queried directly through their links, all in one query
+    # instead of loading each link's Artist separately
     def getArtistsByEvent(self, fromEvent, select):
-        query = self.sess.query(mb.LinkArtistEvent)\
-                         .filter(mb.LinkArtistEvent.entity1 == fromEvent)
-        artistEventLinks = self.queryDB(query, select)
-        artists = [l.entity0 for l in artistEventLinks]
-        return artists
+        query = self.prebuiltQuery('artistsByEvent', eventID=fromEvent.id)
+        artists = self.queryDB(query, select)
+        return [self.shareArtist(artist) for artist in artists]
+
+    # Maximum number of levels climbed when looking for the largest Event
+    # that an Event is part of, as a guard against cyclic links
+    maxEventDepth = 10
 
     # Returns the highest order Event that an Event was part of
     # (e.g. Festival > Day > Stage, get Festival by Stage)
+    # The whole hierarchy is climbed in a single recursive query, numbering
+    # the Events by how many levels above the given one they are
+    @cachedCheck
     def getLargestEventByPart(self, fromEvent):
-        largerEvent = self.getEventByPart(fromEvent)
-        haveLargestEvent = False
-        candidateEvent = fromEvent
-        while not haveLargestEvent:
-            if not largerEvent:
-                largestEvent = candidateEvent
-                haveLargestEvent = True
-            else:
-                candidateEvent = largerEvent
-                largerEvent = self.getEventByPart(largerEvent)
-        return largestEvent
+        largerEvents = self.sess.query(
+                                mb.LinkEventEvent.entity0_id.label('eventID'),
+                                literal(1).label('depth'))\
+                         .filter(mb.LinkEventEvent.entity1_id == fromEvent.id)\
+                         .cte(name='largerEvents', recursive=True)
+        link = aliased(mb.LinkEventEvent)
+        largerEvents = largerEvents.union_all(
+                self.sess.query(link.entity0_id, largerEvents.c.depth + 1)\
+                         .filter(link.entity1_id == largerEvents.c.eventID)\
+                         .filter(largerEvents.c.depth < self.maxEventDepth))
+        query = self.sess.query(mb.Event)\
+                         .join(largerEvents,
+                               largerEvents.c.eventID == mb.Event.id)\
+                         .order_by(largerEvents.c.depth.desc())
+        largestEvent = self.queryDB(query, 'FIRST')
+        if largestEvent:
+            return self.makeEventStub(largestEvent)
+        else:
+            return fromEvent
 
     # Returns the Event that a given Event is immediately part of
     # (e.g. Festival > Day > Stage, get Day by Stage or Festival by Day)
+    # The Event is queried directly through its link, without loading the
+    # link itself
+    @cachedCheck
     def getEventByPart(self, fromEvent):
-        link =  self.sess.query(mb.LinkEventEvent)\
-                    .filter(mb.LinkEventEvent.entity1 == fromEvent)\
-                    .first()
-        if link:
-            return link.entity0
-        else:
-            return None
+        query = self.prebuiltQuery('eventByPart', eventID=fromEvent.id)
+        event = self.queryDB(query, 'FIRST')
+        return self.makeEventStub(event) if event else None
+
+
+# Pools of worker threads shared by every AriadneBackend in the process, rather
+# than each of them keeping its own. They are started on first use and kept
+# for the life of the process
+sharedPools = {}
+sharedPoolsLock = threading.Lock()
+
+# Returns the shared ThreadPool with the given name, starting it with the given
+# number of worker threads if it is not running yet
+def getSharedPool(name, workers):
+    with sharedPoolsLock:
+        if name not in sharedPools:
+            sharedPools[name] = ThreadPool(workers)
+        return sharedPools[name]
 
 
 """
@@ -802,41 +1544,101 @@ class AriadneController(object):
         self.currentKnot = self.startKnot
         self.threads = []
         self.knots = [self.startKnot]
+        # Applicable Thread types by Recording GID, for Knots already checked
+        self.applicableThreadTypes = {}
     
+    # Number of threads of the pool, shared by all Controllers, on which Thread
+    # types are explored
+    exploreWorkers = 16
+
     # Calls the getAllPossibleThreads method of the applicable Thread
     # types
+    # Thread types are explored concurrently, since most of the time goes into
+    # waiting for the DB. Each worker queries on its own session, which is
+    # closed once it is done to return its connection to the pool
     def getAllPossibleThreads(self, applicableThreadTypes, select,
             fromKnot=None):
         if not fromKnot:
             fromKnot = self.currentKnot
+        if not applicableThreadTypes:
+            return []
+        def getThisTypeThreads(ThreadType):
+            try:
+                return ThreadType.getAllPossibleThreads(self.db, fromKnot,
+                        select)
+            finally:
+                self.db.close()
+        pool = getSharedPool('explore', self.exploreWorkers)
+        threadsPerType = pool.map(getThisTypeThreads, applicableThreadTypes)
         threads = []
-        for ThreadType in applicableThreadTypes:
-            thisTypeThreads = ThreadType.getAllPossibleThreads(
-                                    self.db, fromKnot, select)
+        for ThreadType, thisTypeThreads in zip(applicableThreadTypes,
+                threadsPerType):
             threads.append({'type': ThreadType, 'threads': thisTypeThreads})
         return threads
 
+    # Gets the possible Threads from each of several Knots, keyed by Knot, in
+    # the form expected by rank
+    # Each applicable Thread type explores all the Knots it applies to at
+    # once, so that it can share its queries between them. Thread types are
+    # explored concurrently, as in getAllPossibleThreads
+    def getAllPossibleThreadsFromKnots(self, fromKnots, select):
+        knotsByType = OrderedDict((tType, []) for tType in self.allowedThreads)
+        for fromKnot in fromKnots:
+            for tType in self.getApplicableThreadTypes(fromKnot):
+                knotsByType[tType].append(fromKnot)
+        typeKnotsPairs = [(tType, knots)
+                          for tType, knots in knotsByType.items() if knots]
+        threadsByKnot = dict((fromKnot, []) for fromKnot in fromKnots)
+        if not typeKnotsPairs:
+            return threadsByKnot
+        def getThisTypeThreads(typeKnotsPair):
+            ThreadType, thisTypeKnots = typeKnotsPair
+            try:
+                return ThreadType.getAllPossibleThreadsFromKnots(self.db,
+                        thisTypeKnots, select)
+            finally:
+                self.db.close()
+        pool = getSharedPool('explore', self.exploreWorkers)
+        threadsPerType = pool.map(getThisTypeThreads, typeKnotsPairs)
+        for (ThreadType, thisTypeKnots), threadsPerKnot in zip(typeKnotsPairs,
+                threadsPerType):
+            for fromKnot, thisKnotThreads in zip(thisTypeKnots,
+                    threadsPerKnot):
+                threadsByKnot[fromKnot].append({'type': ThreadType,
+                                                'threads': thisKnotThreads})
+        return threadsByKnot
+
     # Calls the isApplicable() method on the allowed Thread types
+    # Applicability only depends on the Recording's Artists, so it is worked
+    # out once per Recording and reused when its Knot is visited again
     def getApplicableThreadTypes(self, fromKnot=None):
         if not fromKnot:
             fromKnot = self.currentKnot
-        return [tType for tType in self.allowedThreads  
+        recGID = fromKnot.rec.gid
+        if recGID not in self.applicableThreadTypes:
+            self.applicableThreadTypes[recGID] = [tType
+                    for tType in self.allowedThreads
                     if tType.isApplicable(self.db, fromKnot)]
+        return self.applicableThreadTypes[recGID]
     
-    # Calls the rank() method on the provided Thread types, and returns only
-    # the specified amount of Threads per Thread type.
+    # Ranks the Threads of the provided Thread types, and returns only
+    # the specified amount of Threads per rank group of each Thread type.
     # Expects input threads in the form:
     # [{'type': ThreadType1, 'threads', [Thread1, Thread2]},
     #  {'type': ThreadType2, 'threads', [Thread3, Thread4]}]
+    # The rank groups of all types are gathered first, so that the random
+    # draws for all of them are made at once
     def rank(self, threads, nThreadsPerType):
-        rankedThreads = []
+        rankGroups = []
         for typeThreadPair in threads:
             thisType = typeThreadPair['type']
             thisTypeThreads = typeThreadPair['threads']
             if thisTypeThreads:
-                thisTypeRankedThreads = thisType.rank(thisTypeThreads,
-                        nThreadsPerType)
-                rankedThreads += thisTypeRankedThreads
+                rankGroups += thisType.rankGroups(thisTypeThreads)
+        rankedThreads = []
+        if rankGroups:
+            for groupBest in Thread.sampleMany(rankGroups, nThreadsPerType):
+                rankedThreads += groupBest
         return rankedThreads
 
     # Sets the currentKnot to the Knot at the given index of the knots list
@@ -894,7 +1696,7 @@ class AriadneClientCLI(object):
     # Get user's choice on the next step
     def getStepChoice(self, bestThreads):
         # Make list of options
-        options = [t.render() for t in bestThreads]
+        options = Thread.renderMany(bestThreads)
         options += ['Refresh possible next songs',
                     'Move to a previous song',
                     'Quit']
@@ -920,10 +1722,12 @@ class AriadneClientCLI(object):
         self.ctrl.currentKnot = thread.toKnot
 
     # Loads the YAML file with the connection strings
+    # It is parsed with the safe loader, using libyaml's C one if available
     @staticmethod
     def loadConnString(conn_string_path):
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
         with open(conn_string_path, 'r') as stream:
-            conn_strings = yaml.load(stream)
+            conn_strings = yaml.load(stream, Loader=loader)
         return conn_strings['alchemy_string']
     
     # Asks the user for a Recording by GID
@@ -944,16 +1748,14 @@ class AriadneClientCLI(object):
     
     # Asks the user for the Thread types they want
     def getAllowedThreadTypes(self):
-       # Get text descriptions for each Thread type
-       threadTypes = Thread.__subclasses__()
-       threadTypeDescs = [tType.descText for tType in threadTypes]
        # Get user's choice from the list of Thread types
        preListText = 'Available Thread types:'
        postListText = 'Enter the numbers of the types you want to use:'
-       allowedThreadTypesInds = self.getMultipleChoice(threadTypeDescs,
+       allowedThreadTypesInds = self.getMultipleChoice(THREAD_TYPE_DESCS,
                                 preListText,
                                 postListText)
-       allowedThreadTypes = [threadTypes[i] for i in allowedThreadTypesInds]
+       allowedThreadTypes = [ALL_THREAD_TYPES[i]
+                             for i in allowedThreadTypesInds]
        return allowedThreadTypes
 
     # Gets the user's choices from a list of strings
@@ -962,18 +1764,17 @@ class AriadneClientCLI(object):
         listInts = [i+1 for i in range(len(stringList))]
         haveChoice = False
         while not haveChoice:
-            print '\n' + preListText
-            for i in listInts:
-                print str(i) + ') ' + stringList[i-1]
+            self.printMenu(stringList, preListText)
             choicesStr = raw_input('\n' + postListText + '\n')
             # If the input is correct (i.e. only numerical), get indices in
             # string list from the ints the user input
             if choicesStr.replace(' ','').isdigit():
                 haveChoice = True
-                inputChars = [c for c in choicesStr]
+                # Numbers are separated by spaces, so that they can have
+                # several digits
+                inputInts = [int(n) for n in re.findall(r'\d+', choicesStr)]
                 # Only keep inds in the right range
-                goodChars = [c for c in inputChars if int(c) in listInts]
-                inds = [int(c)-1 for c in goodChars]
+                inds = [n-1 for n in inputInts if n in listInts]
             else:
                 print('Bad input!')
         return inds
@@ -984,9 +1785,7 @@ class AriadneClientCLI(object):
         listInts = [i+1 for i in range(len(stringList))]
         haveChoice = False
         while not haveChoice:
-            print '\n' + preListText
-            for i in listInts:
-                print str(i) + ') ' + stringList[i-1]
+            self.printMenu(stringList, preListText)
             choiceStr = raw_input('\n' + postListText + '\n')
             # If the input is correct (i.e. only numerical and in the right
             # range), get the matching index
@@ -997,6 +1796,13 @@ class AriadneClientCLI(object):
                 print('Bad input!')
         return ind
 
+    # Prints a list of strings numbered 1-N under a header, in a single write
+    @staticmethod
+    def printMenu(stringList, preListText):
+        menu = '\n'.join('%d) %s' % (i, string)
+                         for i, string in enumerate(stringList, 1))
+        sys.stdout.write('\n' + preListText + '\n' + menu + '\n')
+
     # Gets the best Threads starting at a certain Knot
     def getBestThreads(self, fromKnot=None):
         if not fromKnot:
@@ -1022,17 +1828,44 @@ class AriadneBackend(object):
             conn_string_path='conn_strings.yml',
             possibleThreadsPerThreadType=1,
             rankedThreadsPerThreadType=1,
-            allowedThreadTypes=Thread.__subclasses__()):
-        # Load DB connection details
-        conn_string = AriadneClientCLI.loadConnString(conn_string_path)
-        # Init DB connection
-        self.db = AriadneDB(conn_string, False)
+            allowedThreadTypes=ALL_THREAD_TYPES,
+            prefetchWorkers=2,
+            prefetchTimeout=1,
+            db=None):
+        # Init DB connection, unless an AriadneDB shared with other backends
+        # is given
+        if db is None:
+            # Load DB connection details
+            conn_string = AriadneClientCLI.loadConnString(conn_string_path)
+            db = AriadneDB(conn_string, False)
+        self.db = db
         self.possibleThreadsPerThreadType = possibleThreadsPerThreadType
         self.rankedThreadsPerThreadType = rankedThreadsPerThreadType
         self.allowedThreadTypes = allowedThreadTypes
         self.haveStartingRec = False
         self.threadCounter = 0
         self.knotCounter = 0
+        # Best Threads being worked out in the background for the Knots the
+        # current best Threads lead to, keyed by Knot once ready. Prefetches
+        # run on a pool shared by all backends, with prefetchWorkers threads
+        self.prefetchWorkers = prefetchWorkers
+        self.closed = False
+        # Seconds that a request waits for a prefetch still running before
+        # working its best Threads out itself
+        self.prefetchTimeout = prefetchTimeout
+        self.prefetch = None
+        self.prefetchedKnots = set()
+        # Number of prefetches started, so that queued ones can tell whether
+        # a later one has superseded them
+        self.prefetchCount = 0
+
+    # Stops prefetching for this backend. To be called once the backend is no
+    # longer used. A prefetch not started yet is skipped, and a running one is
+    # left to finish, so that its worker closes its DB session
+    def close(self):
+        self.closed = True
+        self.prefetch = None
+        self.prefetchedKnots = set()
 
     def inputRecording(self, recID):
         defaultRecID = '084a24a9-b289-4584-9fb5-1ca0f7500eb3'
@@ -1050,12 +1883,38 @@ class AriadneBackend(object):
         # Initialize AriadneController
         self.ctrl = AriadneController(self.db, startingRec, self.allowedThreadTypes)
         self.knotCounter +=1
+        # Visited Knots by ID
+        self.knotsByID = dict((k.id, k) for k in self.ctrl.knots)
     
     # Gets the best Threads starting at a certain Knot and stores them as
     # an attribute
+    # If they were prefetched, the background result is used instead of
+    # working them out again, unless prefetching failed or is not done within
+    # prefetchTimeout, or the backend has been closed. Then the best Threads
+    # from each Knot the new best Threads lead to are prefetched, since
+    # following one of them is the most likely next step
     def updateBestThreads(self, fromKnot=None):
         if not fromKnot:
             fromKnot = self.ctrl.currentKnot
+        bestThreads = None
+        prefetch = self.prefetch
+        if (not self.closed and prefetch is not None and
+                fromKnot in self.prefetchedKnots):
+            prefetch.wait(self.prefetchTimeout)
+            if prefetch.ready() and prefetch.successful():
+                prefetched = prefetch.get()
+                if prefetched is not None:
+                    bestThreads = prefetched[fromKnot]
+        if bestThreads is None:
+            bestThreads = self.getBestThreads(fromKnot)
+        # Assign IDs to new best threads and store as attribute, along with
+        # an index of them by ID
+        self.bestThreads = self.assignThreadIDs(bestThreads)
+        self.bestThreadsByID = dict((t.id, t) for t in self.bestThreads)
+        self.prefetchBestThreads(self.bestThreads)
+
+    # Gets the best Threads starting at a certain Knot
+    def getBestThreads(self, fromKnot):
         # Get Thread types that apply for current Knot
         applicableThreadTypes = self.ctrl.getApplicableThreadTypes(fromKnot)
         # Get Threads available from current Knot
@@ -1064,10 +1923,36 @@ class AriadneBackend(object):
                 self.possibleThreadsPerThreadType,
                 fromKnot)
         # Filter possible Threads to get the "best" per type (random atm)
-        bestThreads = self.ctrl.rank(possibleThreads,
+        return self.ctrl.rank(possibleThreads,
                 self.rankedThreadsPerThreadType)
-        # Assign IDs to new best threads and store as attribute
-        self.bestThreads = self.assignThreadIDs(bestThreads)
+
+    # Starts working out in the background the best Threads from the Knots
+    # that some Threads lead to. The previous prefetch is dropped, since its
+    # Knots can no longer be reached. If it has not started yet, it is skipped
+    # All the Knots are explored together, so that each Thread type runs its
+    # queries once for all of them. The worker queries on its own session,
+    # which is closed once it is done
+    # Nothing is prefetched once the backend has been closed
+    def prefetchBestThreads(self, threads):
+        if self.closed:
+            return
+        toKnots = [t.toKnot for t in threads]
+        self.prefetchCount += 1
+        prefetchNumber = self.prefetchCount
+        def prefetchFrom():
+            if self.closed or prefetchNumber != self.prefetchCount:
+                return None
+            try:
+                threadsByKnot = self.ctrl.getAllPossibleThreadsFromKnots(
+                        toKnots, self.possibleThreadsPerThreadType)
+                return dict((toKnot, self.ctrl.rank(threadsByKnot[toKnot],
+                                     self.rankedThreadsPerThreadType))
+                            for toKnot in toKnots)
+            finally:
+                self.db.close()
+        self.prefetchedKnots = set(toKnots)
+        pool = getSharedPool('prefetch', self.prefetchWorkers)
+        self.prefetch = pool.apply_async(prefetchFrom)
         
     # Adds a unique ID to every thread
     def assignThreadIDs(self, threads):
@@ -1079,17 +1964,13 @@ class AriadneBackend(object):
 
     # Updates the Controller to follow a Thread given its ID
     def followThread(self, threadID):
-        # Iterate current bestThreads to get Thread with given ID
-        haveThread = False
-        for t in self.bestThreads:
-            if t.id == threadID:
-                haveThread = True
-                thread = t
-                break
-        if haveThread:
+        # Get the current best Thread with given ID
+        thread = self.bestThreadsByID.get(threadID)
+        if thread:
             thread.toKnot.id = self.knotCounter
             self.ctrl.threads.append(thread)
             self.ctrl.knots.append(thread.toKnot)
+            self.knotsByID[thread.toKnot.id] = thread.toKnot
             self.ctrl.currentKnot = thread.toKnot
             self.knotCounter += 1
         else:
@@ -1097,13 +1978,10 @@ class AriadneBackend(object):
 
     # Updates the Controller to change the current Knot given its ID
     def moveCurrentKnot(self, knotID):
-        # Iterate Knots to get the one with given ID
-        haveKnot = False
-        for k in self.ctrl.knots:
-            if k.id == knotID:
-                haveKnot = True
-                self.ctrl.currentKnot = k
-                break
-        if not haveKnot:
+        # Get the visited Knot with given ID
+        knot = self.knotsByID.get(knotID)
+        if knot:
+            self.ctrl.currentKnot = knot
+        else:
             raise Exception('Bad Knot ID')
 
@@ -5,23 +5,86 @@ import Ariadne
 
 import sys
 
-from flask import Flask, render_template, request, redirect, Response
-import random, json
+from flask import Flask, render_template, request, redirect, Response, \
+        stream_with_context, session
+import random, json, os, uuid, threading, functools
+from collections import OrderedDict
 
 # Useful constants
 ARIADNE_IP = '0.0.0.0'
 ARIADNE_PORT = '5010'
 DEBUG_NO_HTML = True
+CONN_STRING_PATH = 'conn_strings.yml'
+MAX_BACKENDS = 100
+SECRET_KEY_VAR = 'ARIADNE_SECRET_KEY'
 
-# Declare web server app and AriadneBackend object
+# Declare web server app
 app = Flask(__name__)
-backend = None
+# Session cookies are signed with a key given in the environment, so that they
+# stay valid across restarts and in every worker process. Without one, a
+# random key is used, and users have to start again after every restart
+app.secret_key = os.environ.get(SECRET_KEY_VAR)
+if not app.secret_key:
+    sys.stderr.write('%s is not set, using a random secret key\n' %
+            SECRET_KEY_VAR)
+    app.secret_key = os.urandom(24)
+# Every user gets their own AriadneBackend, keyed by the ID stored in their
+# session. All of them share one AriadneDB, whose engine pools connections and
+# gives each request thread its own DB session
+# At most MAX_BACKENDS are kept, dropping the least recently used one
+db = None
+backends = OrderedDict()
+backendsLock = threading.Lock()
+
+# Returns the AriadneBackend of the user making the request, marking it as the
+# most recently used
+def getBackend():
+    sid = session.get('sid')
+    with backendsLock:
+        backend = backends.pop(sid, None)
+        if backend is not None:
+            backends[sid] = backend
+    return backend
+
+# Decorates a route that works on the user's AriadneBackend, passing it as the
+# first argument. Users without one, because they never called / or because
+# theirs was dropped for being the least recently used, are asked to start
+# again instead of failing
+def withBackend(route):
+    @functools.wraps(route)
+    def backendRoute(*args, **kwargs):
+        backend = getBackend()
+        if backend is None:
+            return 'Session expired, call / to start again', 410
+        return route(backend, *args, **kwargs)
+    return backendRoute
 
 # Starting point
+# Closing a backend may wait for its prefetching to stop, so the replaced and
+# dropped backends are only closed once the lock is released, rather than
+# holding up every other user's requests
 @app.route('/')
 def init():
-    global backend
-    backend = Ariadne.AriadneBackend()
+    global db
+    droppedBackends = []
+    with backendsLock:
+        if db is None:
+            connString = Ariadne.AriadneClientCLI.loadConnString(
+                    CONN_STRING_PATH)
+            db = Ariadne.AriadneDB(connString, False)
+        # A user starting again replaces their previous backend
+        sid = session.get('sid')
+        if sid is None:
+            sid = uuid.uuid4().hex
+            session['sid'] = sid
+        oldBackend = backends.pop(sid, None)
+        if oldBackend is not None:
+            droppedBackends.append(oldBackend)
+        backends[sid] = Ariadne.AriadneBackend(db=db)
+        if len(backends) > MAX_BACKENDS:
+            droppedBackends.append(backends.popitem(last=False)[1])
+    for backend in droppedBackends:
+        backend.close()
     
     if DEBUG_NO_HTML:
         return 'Instantiated AriadneBackend.'
@@ -30,7 +93,8 @@ def init():
 
 # Receives a recording UUID to be used as a starting point
 @app.route('/input-recording', methods=['POST'])
-def inputRecording():
+@withBackend
+def inputRecording(backend):
     # Get request content
     try:
         data = request.get_json()
@@ -48,20 +112,24 @@ def inputRecording():
         return 'To be implemented'
 
 # Returns the best Threads starting at the current Knot
+# They are encoded without whitespace, which keeps the payload small and lets
+# json use its C encoder throughout
 @app.route('/get-best-threads', methods=['POST', 'GET'])
-def getBestThreads():
+@withBackend
+def getBestThreads(backend):
     try:
         backend.updateBestThreads()
-        serializedThreads = [t.serialize() for t in backend.bestThreads]
-        result = json.dumps(serializedThreads)
+        serializedThreads = Ariadne.Thread.serializeMany(backend.bestThreads)
+        result = json.dumps(serializedThreads, separators=(',', ':'))
     except Exception as e:
-        result = e.message
+        return e.message
 
-    return result
+    return Response(result, mimetype='application/json')
 
 # Takes a Thread ID and updates the backend to follow it
 @app.route('/follow-thread', methods=['POST'])
-def followThread():
+@withBackend
+def followThread(backend):
     try:
         data = request.get_json()
         threadID = int(data['ThreadID'])
@@ -73,14 +141,34 @@ def followThread():
     return result
 
 # Returns a list of the visited Knots
+# The response body is streamed, serializing one Knot at a time, so that the
+# JSON text of the whole list is never built at once. Optional offset and limit
+# query arguments return only a slice of the list
 @app.route('/get-visited-knots', methods=['POST'])
-def getVisitedKnots():
-    serializedKnots = [k.serialize() for k in backend.ctrl.knots]
-    return json.dumps(serializedKnots)
+@withBackend
+def getVisitedKnots(backend):
+    if not backend.haveStartingRec:
+        return 'No starting recording, call /input-recording first', 409
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    if limit is None:
+        knots = backend.ctrl.knots[offset:]
+    else:
+        knots = backend.ctrl.knots[offset:offset + limit]
+    def generateKnots():
+        yield '['
+        for i, k in enumerate(knots):
+            if i:
+                yield ','
+            yield json.dumps(k.serialize())
+        yield ']'
+    return Response(stream_with_context(generateKnots()),
+            mimetype='application/json')
 
 # Takes a Knot ID and updates the backend to set it as current Knot
 @app.route('/move-current-knot', methods=['POST'])
-def moveCurrentKnot():
+@withBackend
+def moveCurrentKnot(backend):
     try:
         data = request.get_json()
         knotID = int(data['KnotID'])
@@ -91,5 +179,11 @@ def moveCurrentKnot():
 
     return result
 
+# Returns the DB session of the request's thread to the pool once it is done
+@app.teardown_appcontext
+def removeSession(exception):
+    if db is not None:
+        db.close()
+
 if __name__ == '__main__':
     app.run(ARIADNE_IP, ARIADNE_PORT)
@@ -1,7 +1,6 @@
 # demo_backend.py
 # Runs a quick demo of the Ariadne backend
 import Ariadne
-import yaml
 import mbdata.models as mb
 
 def getUserThreadChoice(threads):
@@ -22,9 +21,8 @@ def getUserThreadChoice(threads):
             print('Bad input!')
 
 # Init DB connection
-with open('conn_strings.yml', 'r') as stream:
-    conn_strings = yaml.load(stream)
-db = Ariadne.AriadneDB(conn_strings['alchemy_string'], False)
+db = Ariadne.AriadneDB(
+        Ariadne.AriadneClientCLI.loadConnString('conn_strings.yml'), False)
 print 'Successfully connected to MB database'
 
 # Get starting Recording
@@ -44,8 +42,8 @@ while not haveValidRecordingID:
         print('Bad input!')
 
 # Get allowed Thread types
-threadTypes = Ariadne.Thread.__subclasses__()
-threadTypeDescs = [tType.descText for tType in threadTypes]
+threadTypes = Ariadne.ALL_THREAD_TYPES
+threadTypeDescs = Ariadne.THREAD_TYPE_DESCS
 threadTypeInts = [i+1 for i in range(len(threadTypes))]
 haveAllowedThreadTypes = False
 while not haveAllowedThreadTypes:
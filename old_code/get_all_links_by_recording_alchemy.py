@@ -1,12 +1,9 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, bindparam
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import SQLAlchemyError
 import mbdata.models as models
-import pandas as pd
-import psycopg2, uuid, csv
-# to encode non ascii characters to csv without any decode errors we set "utf8" encoding as default encoding.
-import sys;
-reload(sys);
-sys.setdefaultencoding("utf8")
+import sys
+from itertools import islice, chain
 import yaml
 
 
@@ -15,32 +12,67 @@ import yaml
 
 # Init connection to the DB
 try:
+    #Parsing with the safe loader, using libyaml's C one if available
+    yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
     with open('conn_strings.yml', 'r') as stream:
-        conn_strings = yaml.load(stream)
-
-    #Connecting to the musicbrainz database using psycopg2
-    conn = psycopg2.connect(dbname = conn_strings['dbname'],
-                            user = conn_strings['user'], 
-                            password = conn_strings['password'], 
-                            host = conn_strings['host'])
-    #Initiate the cursor
-    cur = conn.cursor()
+        conn_strings = yaml.load(stream, Loader=yaml_loader)
 
     #Connecting to the musicbrainz database using SQLAlchemy
     #Provide your databse login credentials here in the desired format. Refer to http://docs.sqlalchemy.org/en/latest/core/engines.html
-    engine = create_engine(conn_strings['alchemy_string'], echo=False)
+    engine = create_engine(conn_strings['alchemy_string'], echo=False,
+                           pool_use_lifo=True)
     Session = sessionmaker(bind=engine)
     session = Session()
 
     print "Succesfully connected to the musicbrainz database..."
 
-except:
-    raise ValueError('Unable to connect to the database.., please check your database login credentials...')
+# Only configuration and connection errors are reported as such, keeping the
+# original error and its traceback
+except (IOError, KeyError, yaml.YAMLError, SQLAlchemyError) as e:
+    raise ValueError('Unable to connect to the database.., please check your database login credentials... (%s)' % e), None, sys.exc_info()[2]
+
+
+# Build the recordings query once, with the GIDs as a bound list parameter,
+# so that it can be run for any GIDs reusing its compiled SQL
+# Only their names are needed, so those columns are selected instead of mapped
+# Recording objects
+recordings_by_gids = session.query(models.Recording.gid, models.Recording.name)\
+        .filter(models.Recording.gid.in_(bindparam('gids', expanding=True)))
 
+# Yield the GIDs read one per line from a stream, skipping blank lines
+def read_gids(stream):
+    for line in stream:
+        gid = line.strip()
+        if gid:
+            yield gid
 
-# Query a recording
-example_gid = '1a1f65ba-9de6-4364-adf5-4dc6f550348f'
-results = session.query(models.Recording).filter(models.Recording.gid ==
-        example_gid).all()
-for recording in results:
-    print recording.name
+# Query some recordings, looking up up to gids_per_query of them per query
+# Results are streamed from a server-side cursor, rows_per_fetch at a time,
+# rather than loaded into memory all at once
+# GIDs piped into the script are looked up as they are read, so a batch job
+# can run all of its lookups over the session's one connection instead of
+# starting the script, and connecting, once per GID. The example GIDs are
+# looked up when none are piped in, including when stdin is not a terminal
+# but empty (e.g. under cron or with < /dev/null)
+gids_per_query = 1000
+rows_per_fetch = 500
+example_gids = ['1a1f65ba-9de6-4364-adf5-4dc6f550348f']
+if sys.stdin.isatty():
+    gids = iter([])
+else:
+    gids = read_gids(sys.stdin)
+first_gid = list(islice(gids, 1))
+if first_gid:
+    gids = chain(first_gid, gids)
+else:
+    gids = iter(example_gids)
+while True:
+    batch_gids = list(islice(gids, gids_per_query))
+    if not batch_gids:
+        break
+    results = recordings_by_gids.params(gids=batch_gids)\
+                                .yield_per(rows_per_fetch)
+    # Names are unicode, so they are encoded explicitly when output. The names
+    # of each batch are written at once, rather than printed one by one
+    sys.stdout.write(''.join(recording.name.encode('utf-8') + '\n'
+                             for recording in results))
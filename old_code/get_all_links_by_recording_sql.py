@@ -1,12 +1,9 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-import mbdata.models as models
-import pandas as pd
-import psycopg2, uuid, csv
-# to encode non ascii characters to csv without any decode errors we set "utf8" encoding as default encoding.
-import sys;
-reload(sys);
-sys.setdefaultencoding("utf8")
+from sqlalchemy.exc import SQLAlchemyError
+import uuid
+import sys
+from psycopg2.extras import register_uuid
 import yaml
 
 
@@ -15,35 +12,40 @@ import yaml
 
 # Init connection to the DB
 try:
+    #Parsing with the safe loader, using libyaml's C one if available
+    yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
     with open('conn_strings.yml', 'r') as stream:
-        conn_strings = yaml.load(stream)
-
-    #Connecting to the musicbrainz database using psycopg2
-    conn = psycopg2.connect(dbname = conn_strings['dbname'],
-                            user = conn_strings['user'], 
-                            password = conn_strings['password'], 
-                            host = conn_strings['host'])
-    #Initiate the cursor
-    cur = conn.cursor()
+        conn_strings = yaml.load(stream, Loader=yaml_loader)
 
     #Connecting to the musicbrainz database using SQLAlchemy
     #Provide your databse login credentials here in the desired format. Refer to http://docs.sqlalchemy.org/en/latest/core/engines.html
-    engine = create_engine(conn_strings['alchemy_string'], echo=True)
+    engine = create_engine(conn_strings['alchemy_string'], echo=True,
+                           pool_use_lifo=True)
     Session = sessionmaker(bind=engine)
     session = Session()
 
+    #Getting a psycopg2 connection from the SQLAlchemy engine's pool, instead
+    #of opening a second one to the same database
+    conn = engine.raw_connection()
+    #Initiate the cursor
+    cur = conn.cursor()
+
     print "Succesfully connected to the musicbrainz database..."
 
-except:
-    raise ValueError('Unable to connect to the database.., please check your database login credentials...')
+# Only configuration and connection errors are reported as such, keeping the
+# original error and its traceback
+except (IOError, KeyError, yaml.YAMLError, SQLAlchemyError) as e:
+    raise ValueError('Unable to connect to the database.., please check your database login credentials... (%s)' % e), None, sys.exc_info()[2]
 
 
 # Query a recording
-example_gid = '1a1f65ba-9de6-4364-adf5-4dc6f550348f'
-cur.execute("select * from recording where gid='" + example_gid + "';")
+# The GID is bound as a uuid parameter, so it is sent as a uuid rather than
+# spliced into the SQL as text
+register_uuid()
+example_gid = uuid.UUID('1a1f65ba-9de6-4364-adf5-4dc6f550348f')
+cur.execute("select id from recording where gid=%s;", (example_gid,))
 recording = cur.fetchall()
 recording_id = recording[0][0]
-recording_id_str = str(recording_id)
 
 # Iterate link tables
 l_table_names = [   
@@ -61,76 +63,101 @@ l_table_names = [
                     'l_recording_work'
                     ]
 
-links = []
-
+# Entity tables whose display column is not called name
+name_columns = {'url': 'url'}
+
+# Get the types of entity0 and entity1 from the name of a link table
+def get_entity_types(l_table_name):
+    entity_types = l_table_name[len('l_'):]
+    if entity_types.startswith('recording_'):
+        return 'recording', entity_types[len('recording_'):]
+    return entity_types[:-len('_recording')], 'recording'
+
+# Rows fetched per round trip by the server-side cursors
+cursor_itersize = 500
+
+# Open a named, server-side cursor, which streams its results in batches of
+# cursor_itersize rows instead of pulling them all into memory at once
+# Queries run on it are wrapped in a DECLARE, so they must not end in ";"
+def open_stream_cursor(name):
+    stream_cur = conn.cursor(name=name)
+    stream_cur.itersize = cursor_itersize
+    return stream_cur
+
+# GENERATE QUERY STRING
+# All link tables are queried in a single round trip, tagging each row with
+# the table it comes from
+link_selects = []
 for l_table_name in l_table_names:
-    # GENERATE QUERY STRING
+    select_str = "select '" + l_table_name + "' as src, id, link, " +\
+                 "entity0, entity1 from " + l_table_name + " "
     # Look for current recording in both entities if rec_rec link
     if l_table_name == "l_recording_recording":
-        query_str = "select * from l_recording_recording " +\
-                    "where entity0=" + recording_id_str + " " +\
-                    "or entity1=" + recording_id_str +\
-                    ";"
+        select_str += "where entity0=%(rec)s or entity1=%(rec)s"
     # Look for current recording in left entity if rec_whatever link
     elif l_table_name.split('_')[1] == "recording":
-        query_str = "select * from " + l_table_name + " " +\
-                    "where entity0=" + recording_id_str +\
-                    ";"
+        select_str += "where entity0=%(rec)s"
     elif l_table_name.split('_')[2] == "recording":
-        query_str = "select * from " + l_table_name + " " +\
-                    "where entity1=" + recording_id_str +\
-                    ";"
-    #print query_str
-
-    # Query DB and append results to the links list
-    cur.execute(query_str)
-    query_results = cur.fetchall()
-    if query_results:
-        for item in query_results:
-            links.append(item)
+        select_str += "where entity1=%(rec)s"
+    link_selects.append(select_str)
+query_str = " union all ".join(link_selects)
+#print query_str
+
+# Query DB and group the IDs of the found links by link table
+l_ids_by_table = {}
+links_cur = open_stream_cursor('links_cursor')
+links_cur.execute(query_str, {'rec': recording_id})
+for item in links_cur:
+    l_ids_by_table.setdefault(item[0], []).append(item[1])
+links_cur.close()
 
 #print "\nFound links:"
-#print links
-
-# Iterate links and print information
-for link in links:
-    # Info from the l_*_* table:
-    l_id = link[0]
-    link_id = link[1]
-    entity0 = link[2]
-    entity1 = link[3]
-    isEntity0 = entity0 == recording_id
-
-    # Query link table with this link ID to get info
-    query_str = "select * from link where id=" + str(link_id) + ";"
-    cur.execute(query_str)
-    link_data = cur.fetchall()[0]
-
-    # Get link type from link_type table
-    link_type_id = link_data[1]
-    query_str = "select * from link_type where id=" + str(link_type_id) + ";"
-    cur.execute(query_str)
-    link_type_data = cur.fetchall()[0]
-    entity0_type = link_type_data[4]
-    entity1_type = link_type_data[5]
-    link_phrase = link_type_data[10] # using short one for now
-    reverse_link_phrase = link_type_data[9]
-
-    # Get names of entity0 and entity1
-    entity0_name_query = "select name from " + entity0_type + " " + \
-                         "where id=" + str(entity0) + ";"
-    cur.execute(entity0_name_query)
-    entity0_name = cur.fetchall()[0][0]
-
-    entity1_name_query = "select name from " + entity1_type + " " + \
-                         "where id=" + str(entity1) + ";"
-    cur.execute(entity1_name_query)
-    entity1_name = cur.fetchall()[0][0]
-
-    # If current recording is entity 0 use forward phrase
-    print entity1_type
-    if isEntity0:
-        phrase = entity0_name + " " + link_phrase + " " + entity1_name
-    else:
-        phrase = entity1_name + " " + reverse_link_phrase + " " + entity0_name
-    print phrase
+#print l_ids_by_table
+
+# Iterate link tables and print information
+# The link type and the names of both entities of all the links in a table
+# are fetched in a single query, instead of four queries per link
+for l_table_name in l_table_names:
+    if l_table_name not in l_ids_by_table:
+        continue
+    l_ids = l_ids_by_table[l_table_name]
+    entity0_type, entity1_type = get_entity_types(l_table_name)
+    entity0_name_column = name_columns.get(entity0_type, 'name')
+    entity1_name_column = name_columns.get(entity1_type, 'name')
+    query_str = "select l.entity0, l.entity1, " +\
+                "lt.long_link_phrase, lt.reverse_link_phrase, " +\
+                "e0." + entity0_name_column + ", " +\
+                "e1." + entity1_name_column + " " +\
+                "from " + l_table_name + " l " +\
+                "join link on link.id = l.link " +\
+                "join link_type lt on lt.id = link.link_type " +\
+                "join " + entity0_type + " e0 on e0.id = l.entity0 " +\
+                "join " + entity1_type + " e1 on e1.id = l.entity1 " +\
+                "where l.id = any(%s)"
+    details_cur = open_stream_cursor('details_cursor_' + l_table_name)
+    details_cur.execute(query_str, (l_ids,))
+
+    # The output of each link table is gathered and written at once, rather
+    # than printed line by line
+    output_lines = []
+    for link in details_cur:
+        entity0 = link[0]
+        entity1 = link[1]
+        isEntity0 = entity0 == recording_id
+        link_phrase = link[2] # using short one for now
+        reverse_link_phrase = link[3]
+        entity0_name = link[4]
+        entity1_name = link[5]
+
+        # If current recording is entity 0 use forward phrase
+        output_lines.append(entity1_type)
+        if isEntity0:
+            phrase = entity0_name + " " + link_phrase + " " + entity1_name
+        else:
+            phrase = entity1_name + " " + reverse_link_phrase + " " +\
+                     entity0_name
+        # The engine's connection returns unicode, so the phrase is encoded
+        # explicitly when output
+        output_lines.append(phrase.encode('utf-8'))
+    details_cur.close()
+    sys.stdout.write(''.join(line + '\n' for line in output_lines))